@@ -0,0 +1,53 @@
+"""
+Benchmark the data_flow processing backends (processes, threads, inline) with
+a numpy preprocessor that releases the GIL, for several batch sizes.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/bench_data_flow_backends.py [--length N]
+        [--nb_proc_workers P] [--start_method METHOD]
+"""
+import argparse
+import time
+import numpy as np
+
+from data_tools.io import data_flow
+
+
+def preprocess(batch, rng):
+    x = np.stack(batch[0])
+    x = np.sqrt(x)*np.exp(-x)+rng.rand(*x.shape[1:]).astype(np.float32)
+    return x, np.array(batch[1])
+
+
+def run(length, nb_proc_workers, start_method):
+    rng = np.random.RandomState(0)
+    x = rng.rand(length, 3, 128, 128).astype(np.float32)
+    y = np.arange(length)
+    backends = ['processes', 'threads', 'inline']
+    print("{:>10} {:>12}".format("batch_size", "batch (MB)")
+          +"".join(["{:>16}".format(b+" (b/s)") for b in backends]))
+    for batch_size in [4, 16, 64]:
+        if batch_size > length:
+            break
+        results = []
+        for backend in backends:
+            flow = data_flow([x, y], batch_size=batch_size, nb_io_workers=2,
+                             nb_proc_workers=nb_proc_workers,
+                             preprocessor=preprocess, proc_backend=backend,
+                             start_method=start_method)
+            t = time.perf_counter()
+            for batch in flow:
+                pass
+            results.append(flow.num_batches/(time.perf_counter()-t))
+        batch_mb = batch_size*x[0].nbytes/2**20
+        print("{:>10} {:>12.2f}".format(batch_size, batch_mb)
+              +"".join(["{:>16.1f}".format(r) for r in results]))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--nb_proc_workers', type=int, default=2)
+    parser.add_argument('--start_method', type=str, default=None)
+    args = parser.parse_args()
+    run(args.length, args.nb_proc_workers, args.start_method)
@@ -0,0 +1,70 @@
+"""
+Benchmark the overhead of the data_flow pipeline itself: the CPU time it
+burns while the consumer is busy and every queue is full, and the per-batch
+handoff latency when batches are trivial to load and process.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/bench_data_flow_idle.py [--nb_io_workers T]
+        [--nb_proc_workers P] [--idle_seconds S]
+"""
+import argparse
+import resource
+import time
+import numpy as np
+
+from data_tools.io import data_flow
+
+
+def cpu_seconds():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime+self_usage.ru_stime
+            +children_usage.ru_utime+children_usage.ru_stime)
+
+
+def idle_cpu(nb_io_workers, nb_proc_workers, idle_seconds):
+    # Fill the pipeline, then leave it idle while the consumer "works".
+    # Child processes are only accounted for once they are joined, so the
+    # whole lifetime of the flow is measured, minus the time spent starting
+    # up and shutting down without idling.
+    def run(idle):
+        flow = data_flow([np.arange(10**6)], batch_size=1,
+                         nb_io_workers=nb_io_workers,
+                         nb_proc_workers=nb_proc_workers)
+        t = cpu_seconds()
+        gen = flow.flow()
+        next(gen)
+        time.sleep(idle)
+        gen.close()
+        return cpu_seconds()-t
+    baseline = run(0)
+    return (run(idle_seconds)-baseline)/idle_seconds
+
+
+def handoff_latency(nb_io_workers, nb_proc_workers, nb_batches=5000):
+    flow = data_flow([np.arange(nb_batches)], batch_size=1,
+                     nb_io_workers=nb_io_workers,
+                     nb_proc_workers=nb_proc_workers)
+    gen = flow.flow()
+    next(gen)
+    t = time.perf_counter()
+    for _ in gen:
+        pass
+    return (time.perf_counter()-t)/(nb_batches-1)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nb_io_workers', type=int, default=8)
+    parser.add_argument('--nb_proc_workers', type=int, default=16)
+    parser.add_argument('--idle_seconds', type=float, default=5)
+    args = parser.parse_args()
+    print("{:>14} {:>16} {:>20} {:>22}".format(
+        "nb_io_workers", "nb_proc_workers", "idle CPU (cores)",
+        "handoff latency (us)"))
+    for nb_proc_workers in sorted(set([0, args.nb_proc_workers])):
+        cores = idle_cpu(args.nb_io_workers, nb_proc_workers,
+                         args.idle_seconds)
+        latency = handoff_latency(args.nb_io_workers, nb_proc_workers)
+        print("{:>14} {:>16} {:>20.3f} {:>22.1f}".format(
+            args.nb_io_workers, nb_proc_workers, cores, latency*1e6))
@@ -0,0 +1,58 @@
+"""
+Benchmark reading a compressed HDF5 dataset with data_flow loader threads
+against loader processes (which each reopen the file), for several numbers of
+loaders.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/bench_data_flow_io_backends.py [--length N]
+        [--batch_size B] [--start_method METHOD]
+"""
+import argparse
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from data_tools.io import data_flow
+from data_tools.wrap import file_source
+
+
+def run(length, batch_size, start_method):
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'data.h5')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('x', data=rng.rand(length, 3, 64, 64),
+                         chunks=(batch_size, 3, 64, 64), compression='gzip')
+        f.create_dataset('y', data=np.arange(length))
+    data = [file_source(path, 'x'), file_source(path, 'y')]
+    backends = ['threads', 'processes']
+    print("{:>14}".format("nb_io_workers")
+          +"".join(["{:>18}".format(b+" (b/s)") for b in backends]))
+    for nb_io_workers in [1, 2, 4]:
+        results = []
+        for backend in backends:
+            flow = data_flow(data, batch_size=batch_size,
+                             nb_io_workers=nb_io_workers, stack_batches=True,
+                             sample_random='block', io_backend=backend,
+                             start_method=start_method)
+            t = time.perf_counter()
+            for batch in flow:
+                pass
+            results.append(flow.num_batches/(time.perf_counter()-t))
+        print("{:>14}".format(nb_io_workers)
+              +"".join(["{:>18.1f}".format(r) for r in results]))
+    for source in data:
+        source.close()
+    os.remove(path)
+    os.rmdir(tmp_dir)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=4096)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--start_method', type=str, default=None)
+    args = parser.parse_args()
+    run(args.length, args.batch_size, args.start_method)
@@ -0,0 +1,52 @@
+"""
+Benchmark passing batches from data_flow processing processes to the consumer
+by pickling them through queues against passing them through shared memory,
+for several batch sizes.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/bench_data_flow_transport.py [--length N]
+        [--nb_proc_workers P]
+"""
+import argparse
+import time
+import numpy as np
+
+from data_tools.io import data_flow
+
+
+def stack(batch):
+    return np.stack(batch[0]), np.array(batch[1])
+
+
+def run(length, nb_proc_workers):
+    rng = np.random.RandomState(0)
+    x = rng.rand(length, 3, 128, 128).astype(np.float32)
+    y = np.arange(length)
+    print("{:>10} {:>12} {:>14} {:>14} {:>14} {:>14}".format(
+        "batch_size", "batch (MB)", "pickle (b/s)", "pickle (MB/s)",
+        "shm (b/s)", "shm (MB/s)"))
+    for batch_size in [4, 16, 64, 256]:
+        if batch_size > length:
+            break
+        results = []
+        for shared_memory in [False, True]:
+            flow = data_flow([x, y], batch_size=batch_size, nb_io_workers=2,
+                             nb_proc_workers=nb_proc_workers,
+                             preprocessor=stack, shared_memory=shared_memory)
+            t = time.perf_counter()
+            nbytes = 0
+            for batch_x, _ in flow:
+                nbytes += batch_x.nbytes
+            t = time.perf_counter()-t
+            results.extend([flow.num_batches/t, nbytes/t/2**20])
+        batch_mb = batch_size*x[0].nbytes/2**20
+        print("{:>10} {:>12.2f} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}"
+              "".format(batch_size, batch_mb, *results))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=2048)
+    parser.add_argument('--nb_proc_workers', type=int, default=2)
+    args = parser.parse_args()
+    run(args.length, args.nb_proc_workers)
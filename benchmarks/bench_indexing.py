@@ -0,0 +1,48 @@
+"""
+Benchmark indexing into a delayed_view against indexing the same numpy array
+directly, for keys selecting 10^3 to 10^6 elements.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/bench_indexing.py [--length N] [--repeat R]
+"""
+import argparse
+import timeit
+import numpy as np
+
+from data_tools.wrap import delayed_view
+
+
+def run(length, repeat):
+    rng = np.random.RandomState(0)
+    arr = rng.rand(length, 2, 16).astype(np.float32)
+    views = [('delayed_view', delayed_view(arr)),
+             ('delayed_view (shuffled)', delayed_view(arr, shuffle=True,
+                                                      rng=rng))]
+    print("{:>8} {:<12} {:>12} {:>14} {:>24}".format(
+        "n", "key", "ndarray (s)", "delayed_view", "delayed_view (shuffled)"))
+    n = 1000
+    while n <= length:
+        idx = np.sort(rng.choice(length, size=n, replace=False))
+        mask = np.zeros(length, dtype=bool)
+        mask[idx] = True
+        keys = [('int array', idx),
+                ('bool mask', mask),
+                ('mixed', (idx, slice(None), slice(4, 12))),
+                ('slice', slice(0, n))]
+        for key_name, key in keys:
+            t_arr = min(timeit.repeat(lambda: arr[key], number=1,
+                                      repeat=repeat))
+            t_views = [min(timeit.repeat(lambda: v[key], number=1,
+                                         repeat=repeat))
+                       for _, v in views]
+            print("{:>8} {:<12} {:>12.5f} {:>14.5f} {:>24.5f}".format(
+                n, key_name, t_arr, *t_views))
+        n *= 10
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=10**6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.length, args.repeat)
@@ -0,0 +1,96 @@
+"""
+Check the sharding of data_flow with local processes: world_size processes,
+one per rank, each iterate over their share of the same data for a few
+epochs. For every epoch, the shares must be disjoint and cover the data
+(padded up to a multiple of world_size with pad_shards, or with the
+remainder dropped without), and all ranks must yield the same number of
+batches, so that they stay in lockstep.
+
+Usage (from the root of the repository):
+    PYTHONPATH=. python benchmarks/check_sharding.py [--length N]
+        [--world_size W] [--batch_size B] [--num_epochs E]
+"""
+import argparse
+import multiprocessing
+import sys
+import numpy as np
+
+from data_tools.io import data_flow
+
+
+def run(rank, world_size, pad_shards, length, batch_size, num_epochs,
+        results):
+    # Record the elements of every batch that this rank yields in each epoch.
+    flow = data_flow([np.arange(length)], batch_size=batch_size,
+                     sample_random=True, rank=rank, world_size=world_size,
+                     pad_shards=pad_shards, sample_seed=1234,
+                     rng=np.random.RandomState(rank))
+    epochs = []
+    for epoch in range(num_epochs):
+        epochs.append([np.asarray(batch[0]) for batch in flow.flow()])
+    flow.close()
+    results.put((rank, len(flow), epochs))
+
+
+def check(length, world_size, batch_size, num_epochs, pad_shards):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run,
+                                         args=(rank, world_size, pad_shards,
+                                               length, batch_size, num_epochs,
+                                               results))
+                 for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    ranks = sorted([results.get() for p in processes], key=lambda r: r[0])
+    for p in processes:
+        p.join()
+
+    if pad_shards:
+        expected = -(-length//world_size)*world_size
+    else:
+        expected = length//world_size*world_size
+    errors = []
+    orders = []
+    for epoch in range(num_epochs):
+        nb_batches = [len(epochs[epoch]) for _, _, epochs in ranks]
+        shares = [np.concatenate(epochs[epoch]) for _, _, epochs in ranks]
+        elements = np.concatenate(shares)
+        orders.append(elements)
+        print("pad_shards={}, epoch {}: {} elements, {} unique, batches per "
+              "rank {}".format(pad_shards, epoch, len(elements),
+                               len(np.unique(elements)), nb_batches))
+        if len(set(nb_batches))!=1:
+            errors.append("the ranks are not in lockstep")
+        if nb_batches!=[num_batches for _, num_batches, _ in ranks]:
+            errors.append("a rank yielded other than len(flow) batches")
+        if len(set([len(share) for share in shares]))!=1:
+            errors.append("the shares are not of equal size")
+        if len(elements)!=expected:
+            errors.append("{} elements instead of {}".format(len(elements),
+                                                             expected))
+        # The shares follow each other in the order of the epoch; only the
+        # padding, taken from the start of the epoch, may repeat elements.
+        nb_unique = min(length, expected)
+        if len(np.unique(elements[:nb_unique]))!=nb_unique:
+            errors.append("the shares are not disjoint")
+    if num_epochs > 1 and all([np.array_equal(orders[0], order)
+                               for order in orders[1:]]):
+        errors.append("every epoch has the same order")
+    for error in errors:
+        print("FAILED (pad_shards={}): {}".format(pad_shards, error))
+    return not errors
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=103)
+    parser.add_argument('--world_size', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_epochs', type=int, default=2)
+    args = parser.parse_args()
+    ok = True
+    for pad_shards in [True, False]:
+        ok = check(args.length, args.world_size, args.batch_size,
+                   args.num_epochs, pad_shards) and ok
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
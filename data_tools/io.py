@@ -1,6 +1,17 @@
+import asyncio
+import atexit
+import functools
 import time
 import threading
 import multiprocessing
+import inspect
+import json
+import logging
+import os
+import pickle
+import traceback
+import warnings
+from collections import deque
 try:
     import queue            # python 3
 except ImportError:
@@ -8,6 +19,15 @@ except ImportError:
 
 import numpy as np
 
+from .wrap import (delayed_view,
+                   _block_shuffle,
+                   _gather,
+                   _get_chunk_length,
+                   _lru_cache,
+                   _reopen)
+
+
+logger = logging.getLogger(__name__)
 
 class data_flow(object):
     """
@@ -21,46 +41,216 @@ class data_flow(object):
     batch_size : The maximum number of elements to yield from each data array
         in a batch. The actual batch size is the smallest of either this number
         or the number of elements not yet yielded in the current epoch.
-    nb_io_workers : The number of parallel threads to preload data. NOTE that
-        if nb_io_workers > 1, data is loaded asynchronously.
+    nb_io_workers : The number of parallel threads (or processes; see
+        io_backend) to preload data. NOTE that if nb_io_workers > 1, data is
+        loaded asynchronously.
     nb_proc_workers : The number of parallel processes to do preprocessing of
         data using the _process_batch function. If nb_proc_workers is set to 0,
         no parallel processes will be launched; instead, any preprocessing will
         be done in the preload thread and data will have to pass through only
         one queue rather than two queues. NOTE that if nb_proc_workers > 1,
         data processing is asynchronous and data will not be yielded in the
-        order that it is loaded!
+        order that it is loaded, unless ordered is True!
     loop_forever : If False, stop iteration at the end of an epoch (when all
         data has been yielded once).
-    sample_random : If True, sample the data in random order.
+    sample_random : If True, sample the data in random order. If 'block',
+        sample blocks of consecutive elements in random order and shuffle the
+        elements within a sliding window of blocks (see wrap.delayed_view), so
+        that each storage chunk is read within a short span of batches.
     sample_with_replacement : If True, sample data with replacement when doing
         random sampling.
     sample_weights : A list of relative importance weights for each element in
         the dataset, specifying the relative probability with which that
-        element should be sampled, when using random sampling.
+        element should be sampled, when using random sampling. The weights
+        can be changed with update_weights().
     drop_incomplete_batches : If true, drops batches smaller than the batch
         size. If the dataset size is not divisible by the batch size, then when
         sampling without replacement, there is one such batch per epoch.
     preprocessor : The preprocessor function to call on a batch. As input,
-        takes a batch of the same arrangement as `data`.
+        takes a batch of the same arrangement as `data`. If it accepts an
+        `rng` keyword argument, it is passed a numpy RandomState to use for
+        any randomness.
     index_sampler : An iterator that returns array indices according
         to some sampling strategy. By default, uses wrap.index_sampler,
         initialized to do random sampling without replacement.
     rng : A numpy random number generator. The rng is used to determine data
         shuffle order and is used to uniquely seed the numpy RandomState in
         each parallel process (if any).
+    sample_block_size : The number of elements in a block when sample_random
+        is 'block'. If None, it is taken from the chunk shape of the first
+        data array that is chunked (eg. an h5py or zarr dataset) or from the
+        block size of the first delayed_view or multi_source_array whose
+        block size is more than 1, else 1.
+    sample_block_window : The number of blocks over which elements are
+        shuffled together when sample_random is 'block'.
+    shared_memory : If True, pass batches between the loader threads, the
+        processing processes, and the consumer through rings of preallocated
+        shared memory slots instead of pickling them through queues; only slot
+        numbers and array shapes and dtypes pass through the queues. NOTE that
+        the arrays in a yielded batch are then views into a shared memory slot
+        that is reused once the next batch is requested, so a batch must be
+        copied if it is needed beyond that.
+    shm_slot_bytes : The size of each shared memory slot, in bytes. If None,
+        the size of a batch as loaded (batch_size elements of every data
+        array), which suffices when preprocessing does not enlarge batches.
+        Batches that do not fit in a slot are pickled through the queue.
+    ordered : If True, yield batches in the order in which they are sampled,
+        whatever the number of loader threads and processing processes, and
+        seed the randomness used to preprocess each batch from the rng, the
+        epoch, and the index of the batch in the epoch rather than per worker.
+        The output is then reproducible for a given rng seed and does not
+        depend on the number of workers. Batches that arrive early wait in a
+        reorder buffer, bounded by limiting the number of batches in flight.
+    stack_batches : If True, read a batch from each array-like data source
+        (one with a shape and dtype) with a single bulk read into a contiguous
+        numpy array taken from a pool of recycled buffers, instead of reading
+        a list of elements one by one. Sources that require increasing indices
+        (eg. h5py datasets) are read in sorted runs of indices. A batch then
+        holds one array per array-like source; other sources still give a
+        list of elements. Buffers passed on to processing threads (with the
+        'threads' proc_backend and loader threads) are not recycled, since
+        the batch is not copied.
+    persistent_workers : If True, keep the loader threads, processing
+        processes, and queues alive across calls to flow() (one epoch each,
+        unless loop_forever is True) until close() is called, or the
+        data_flow is used as a context manager and the context exits. The
+        next epoch is prefetched while the current one is being consumed.
+    metrics : If True, record the time spent in every stage of the pipeline
+        (sampling indices, reading, preprocessing, shared memory transport,
+        and waiting on queues), the bytes that each stage moves, the depth
+        of the queues, and the time that the consumer waits for batches;
+        see stats(). If 'trace', also keep the most recent of these as
+        events to export with export_trace(). If False, nothing is recorded.
+    prefetch : The maximum number of batches in flight (sampled but not yet
+        yielded); the queues are sized to hold them. If None, the number of
+        batches in flight is only bounded by the size of the queues,
+        max(nb_io_workers, nb_proc_workers) each (with ordered,
+        persistent_workers, or autotune, it is bounded by a default depth
+        of 3*max(nb_io_workers, nb_proc_workers)+nb_io_workers
+        +nb_proc_workers).
+    autotune : If True, tune nb_io_workers, nb_proc_workers, and prefetch
+        while the data_flow runs: every autotune_batches batches, if the
+        consumer stalled waiting for batches, add a worker to the busiest
+        stage or, if no stage is busy, increase prefetch, within the max_workers
+        and max_prefetch_bytes budgets. Processing processes are only added if
+        nb_proc_workers > 0. Since forking a process whose threads are
+        running can deadlock the child (eg. on a lock held by a reading
+        thread), processes (processing processes, or loader processes with
+        the 'processes' io_backend) are only added if the start_method is
+        not 'fork'; otherwise, only threads and prefetch are tuned. Tuning
+        stops once the consumer no longer stalls
+        or the budgets are reached, and the chosen configuration is logged
+        (at the INFO level) and kept in the nb_io_workers, nb_proc_workers,
+        and prefetch attributes. Tuning records metrics (see stats()).
+    autotune_batches : The number of batches over which to measure the
+        throughput of the stages before each tuning step.
+    max_workers : The maximum total number of loader threads and processing
+        processes when tuning. If None, the number of CPUs.
+    max_prefetch_bytes : The maximum size, in bytes, of the batches in flight
+        when tuning. If None, prefetch is only bounded by 4*max_workers.
+        The queues and shared memory rings are sized for as many batches as
+        fit in this budget, at the size of a batch as loaded (or
+        shm_slot_bytes, if set).
+    rank : The rank of this data_flow among world_size data_flows (eg. one
+        per training process) over the same data, each of which reads and
+        processes a disjoint share of every epoch (see index_sampler).
+    world_size : The number of data_flows that share every epoch.
+    pad_shards : If True, every rank gets ceil(N/world_size) of the N
+        elements of an epoch, padding the epoch with elements from its
+        start; if False, every rank gets floor(N/world_size) elements and
+        the rest are dropped. Either way, all ranks yield the same number of
+        batches per epoch.
+    sample_seed : If not None, an integer from which the sampling order of
+        every epoch is seeded, along with the epoch number, instead of
+        drawing it from rng. Must be the same on all ranks; required when
+        world_size > 1 with random sampling without replacement.
+    proc_backend : How the nb_proc_workers processing workers are run:
+        'processes' (the default) runs them in processes, to which batches
+        are passed by pickling them or through shared memory; 'threads'
+        runs them in threads of this process, to which batches are passed
+        without copying, which is cheaper for preprocessors that release the
+        GIL (eg. most numpy and scipy.ndimage functions) and does not require
+        the preprocessor to be picklable; 'inline' preprocesses in the
+        loader threads, as with nb_proc_workers=0. Every worker passes its
+        own seeded RandomState to a preprocessor that takes an `rng`
+        argument; processes also seed their global numpy random state, which
+        threads share.
+    start_method : The multiprocessing start method of the processing
+        processes, if proc_backend is 'processes', and of the loader
+        processes, if io_backend is 'processes': 'fork', 'spawn', or
+        'forkserver'. If None, the default of the platform. Processes
+        started with 'spawn' or 'forkserver' do not inherit locks held by
+        threads (eg. threads reading h5py files), but the preprocessor (and
+        the data, for loader processes) must then be picklable (eg. a
+        function defined at the top level of a module).
+    io_backend : How the nb_io_workers loaders are run: 'threads' (the
+        default) runs them in threads of this process; 'processes' runs them
+        in processes, so that data is read and decompressed in parallel even
+        from libraries that serialize all access behind a global lock (eg.
+        h5py). Every loader process reopens each data array that can be
+        reopened (a wrap.file_source, or a delayed_view or
+        multi_source_array over file_sources) instead of using file handles
+        inherited from this process; other data arrays are inherited or,
+        with the 'spawn' and 'forkserver' start methods, pickled. Loaded
+        batches are passed on by pickling them or through shared memory. If
+        nb_proc_workers is 0, batches are preprocessed in the loader
+        processes.
+    cache_fn : A deterministic function to apply to every sample, whose
+        outputs are cached in sample_cache so that it is computed once per
+        sample rather than every epoch; randomness is left to the
+        preprocessor, which is applied on top. It takes a sample, a list with
+        one element per data array (eg. [A[i], B[i], C[i]]), and returns a
+        list or tuple of outputs. The loaders then only read the samples
+        that are not cached, and the batches passed to the preprocessor
+        hold, for every output, the list of that output for each sample in
+        the batch (or, if stack_batches is True, the stacked array, if the
+        outputs are arrays). With a memory_sample_cache and stack_batches
+        False, the arrays in these lists are the cached arrays themselves,
+        shared and read-only, whereas a disk_sample_cache always gives
+        copies; a preprocessor that modifies them in place must copy them
+        first.
+    sample_cache : Where to cache the outputs of cache_fn: a
+        memory_sample_cache, which keeps them in memory within a byte budget,
+        or a disk_sample_cache, which keeps them on disk, shared by all
+        loaders and across runs. If None, a memory_sample_cache of 1 GiB. A
+        disk_sample_cache is required with the 'processes' io_backend, since
+        loader processes cannot share a cache in memory.
+    cache_version : A key identifying cache_fn (a value that can be saved
+        as JSON, eg. a string). When a flow starts, the sample_cache is
+        cleared if it holds outputs cached with another cache_version; change
+        it whenever cache_fn changes.
     """
     
     def __init__(self, data, batch_size, nb_io_workers=1, nb_proc_workers=0,
                  loop_forever=False, sample_random=False,
                  sample_with_replacement=False, sample_weights=None,
-                 drop_incomplete_batches=False, preprocessor=None, rng=None):
+                 drop_incomplete_batches=False, preprocessor=None, rng=None,
+                 sample_block_size=None, sample_block_window=4,
+                 shared_memory=False, shm_slot_bytes=None, ordered=False,
+                 stack_batches=False, persistent_workers=False,
+                 metrics=False, prefetch=None, autotune=False,
+                 autotune_batches=20, max_workers=None,
+                 max_prefetch_bytes=None, rank=0, world_size=1,
+                 pad_shards=True, sample_seed=None, proc_backend='processes',
+                 start_method=None, io_backend='threads', cache_fn=None,
+                 sample_cache=None, cache_version=None):
         self.data = data
         self.batch_size = batch_size
         self.nb_io_workers = nb_io_workers
         if not nb_io_workers>0:
             raise ValueError("nb_io_workers must be 1 or more")
+        if proc_backend not in ('processes', 'threads', 'inline'):
+            raise ValueError("proc_backend must be 'processes', 'threads', "
+                             "or 'inline'.")
+        if proc_backend=='inline':
+            nb_proc_workers = 0
         self.nb_proc_workers = nb_proc_workers
+        self.proc_backend = proc_backend
+        if io_backend not in ('threads', 'processes'):
+            raise ValueError("io_backend must be 'threads' or 'processes'.")
+        self.io_backend = io_backend
+        self.start_method = start_method
+        self._mp = multiprocessing.get_context(start_method)
         self.loop_forever = loop_forever
         self.sample_random = sample_random
         self.sample_with_replacement = sample_with_replacement
@@ -69,19 +259,83 @@ class data_flow(object):
         if not sample_with_replacement and np.any(self.sample_weights==0):
             raise ValueError("When sampling without replacement, sample "
                              "weights must never be zero.")
+        self._weight_tree = None
+        if sample_weights is not None:
+            self._weight_tree = sum_tree(sample_weights)
+        if sample_block_size is None:
+            for d in self.data:
+                sample_block_size = _get_chunk_length(d)
+                if sample_block_size is not None:
+                    break
+        self.sample_block_size = sample_block_size
+        self.sample_block_window = sample_block_window
+        self.shared_memory = shared_memory
+        self.shm_slot_bytes = shm_slot_bytes
+        self.ordered = ordered
+        self.stack_batches = stack_batches
+        self.persistent_workers = persistent_workers
+        self.metrics = metrics
+        self.prefetch = prefetch
+        if prefetch is not None and not prefetch>0:
+            raise ValueError("prefetch must be 1 or more")
+        self.autotune = autotune
+        self._stats = None
+        if metrics or autotune:
+            self._stats = _flow_stats(trace=(metrics=='trace'))
+        self._tuner = None
+        if autotune:
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            self._tuner = _autotuner(window=autotune_batches,
+                                     max_workers=max_workers,
+                                     max_prefetch_bytes=max_prefetch_bytes)
+        self._pipeline = None
+        self._async_pump = None
                              
         if preprocessor is not None:
             self._process_batch = preprocessor
         else:
-            self._process_batch = lambda x: x   # Do nothing by default
+            self._process_batch = _identity   # Do nothing by default
+        self._processor = _batch_processor(self._process_batch, ordered,
+                                           metrics=self._stats is not None)
+        self.cache_fn = cache_fn
+        self.cache_version = cache_version
+        if cache_fn is None and sample_cache is not None:
+            raise ValueError("A sample_cache requires a cache_fn.")
+        if (cache_fn is not None and io_backend=='processes'
+                and (sample_cache is None
+                     or isinstance(sample_cache, memory_sample_cache))):
+            raise ValueError("Loader processes cannot share a "
+                             "memory_sample_cache; pass a disk_sample_cache "
+                             "as the sample_cache with the 'processes' "
+                             "io_backend.")
+        if cache_fn is not None and sample_cache is None:
+            sample_cache = memory_sample_cache(max_bytes=2**30)
+        self.sample_cache = sample_cache
         if rng is None:
             self.rng = np.random.RandomState()
         else:
             self.rng = rng
+        self.rank = rank
+        self.world_size = world_size
+        self.pad_shards = pad_shards
+        self.sample_seed = sample_seed
+        if not 0 <= rank < world_size:
+            raise ValueError("The rank must be in [0, world_size).")
+        if (world_size > 1 and sample_random and not sample_with_replacement
+                and sample_seed is None):
+            raise ValueError("A sample_seed shared by all ranks is required "
+                             "to shard random sampling without replacement.")
+        self.epoch = 0      # The epoch that the next flow() yields.
+        self._consumed = {} # {epoch: batches yielded}, for unfinished epochs.
+        self._resume = None # The state to resume from, if loaded.
+        self._active_pipeline = None
         
-        self.num_samples = len(data[0])
+        self.data_length = len(data[0])
         for d in self.data:
-            assert(len(d)==self.num_samples)
+            assert(len(d)==self.data_length)
+        self.num_samples = shard_length(self.data_length, world_size,
+                                        pad_shards)
         
         self.num_batches = self.num_samples//self.batch_size
         if self.num_samples%batch_size > 0 and not drop_incomplete_batches:
@@ -92,261 +346,2155 @@ class data_flow(object):
         
     ''' Generate batches of processed data (output with labels) '''
     def flow(self):
-        # Create a stop event to trigger on exceptions/interrupt/termination.
-        stop = multiprocessing.Event()
+        batches = self._flow()
+        try:
+            for batch, release in batches:
+                try:
+                    yield batch
+                finally:
+                    # The consumer is done with the batch.
+                    del batch
+                    release()
+        finally:
+            batches.close()
+            
+    async def aflow(self):
+        """
+        Asynchronously generate batches of processed data, as flow() does,
+        without blocking the event loop. Several consumers (eg. tasks) may
+        iterate over aflow() concurrently: they share one flow() and each
+        batch goes to one of them. The flow is stopped once all consumers
+        are done or cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        pump = self._async_pump
+        if pump is None or pump.finished:
+            prefetch = max(self.nb_io_workers, self.nb_proc_workers)
+            pump = _async_pump(self._flow(), loop, prefetch)
+            self._async_pump = pump
+        elif pump.loop is not loop:
+            raise RuntimeError("aflow() is already being iterated over in "
+                               "another event loop.")
+        pump.nb_consumers += 1
+        try:
+            while True:
+                kind, value = await pump.queue.get()
+                if kind!='batch':
+                    # The flow is over; let the other consumers know.
+                    pump.finished = True
+                    pump.queue.put_nowait((kind, value))
+                    if kind=='error':
+                        raise value
+                    return
+                pump.free_slots.release()
+                batch, release = value
+                try:
+                    yield batch
+                finally:
+                    # The consumer is done with the batch.
+                    del batch
+                    release()
+        finally:
+            pump.nb_consumers -= 1
+            if pump.nb_consumers==0:
+                pump.finished = True
+                if self._async_pump is pump:
+                    self._async_pump = None
+                await pump.close()
+                
+    def _flow(self):
+        # Yield (batch, release) pairs, where release() must be called once
+        # the consumer is done with the batch.
+        pipeline = self._pipeline
+        if pipeline is None:
+            pipeline = self._start_pipeline()
+            if self.persistent_workers:
+                self._pipeline = pipeline
+        elif pipeline.in_use:
+            raise RuntimeError("A data_flow with persistent workers can only "
+                               "be iterated over by one flow() at a time.")
+        pipeline.in_use = True
+        self._active_pipeline = pipeline
+        keep_pipeline = False
+        try:
+            # Each call yields the next epoch, dropping any batches left over
+            # from an epoch that was not fully consumed. Every epoch has
+            # num_batches batches, with consecutive sequence numbers. When
+            # resuming, batches that were already consumed are not sampled
+            # and their sequence numbers are skipped.
+            epoch = pipeline.next_epoch
+            pipeline.next_epoch += 1
+            self.epoch = pipeline.first_epoch+pipeline.next_epoch
+            first_seq = epoch*self.num_batches
+            end_seq = None
+            if not self.loop_forever:
+                end_seq = first_seq+self.num_batches
+            pipeline.drop_stale(first_seq)
+            
+            # Yield batches fetched from the parallel process(es).
+            rec = self._new_recorder('consumer')
+            nb_yielded = len([seq for seq in pipeline.skipped
+                              if first_seq <= seq < first_seq+self.num_batches])
+            seq = first_seq
+            while self.loop_forever or nb_yielded < self.num_batches:
+                t = rec.clock()
+                if self.ordered:
+                    while seq in pipeline.skipped:
+                        seq += 1
+                    meta, payload = self._get_batch(pipeline, seq, seq+1)
+                    seq += 1
+                else:
+                    meta, payload = self._get_batch(pipeline, first_seq,
+                                                    end_seq)
+                rec.record('stall', t)
+                if meta['epoch']-pipeline.first_epoch >= pipeline.next_epoch:
+                    pipeline.next_epoch = meta['epoch']-pipeline.first_epoch+1
+                    self.epoch = pipeline.first_epoch+pipeline.next_epoch
+                self._set_consumed(pipeline, meta['epoch'], meta['batch'])
+                batch, slot = _receive_batch(payload, pipeline.proc_ring)
+                if self._stats is not None:
+                    rec.attach(meta)
+                    self._stats.add_batch(meta, pipeline.get_queue_depths())
+                if self._tuner is not None:
+                    self._tuner.step(self, pipeline)
+                t = rec.clock()
+                yield batch, functools.partial(pipeline.release, slot)
+                rec.record('busy', t)
+                nb_yielded += 1
+            keep_pipeline = self.persistent_workers
+        except GeneratorExit:
+            keep_pipeline = self.persistent_workers
+            raise
+        finally:
+            # Epochs that were not finished are abandoned.
+            self._consumed.clear()
+            pipeline.in_use = False
+            self._active_pipeline = None
+            if not keep_pipeline:
+                self._stop_pipeline(pipeline)
+                
+    def _set_consumed(self, pipeline, epoch, batch):
+        consumed = self._consumed.setdefault(epoch, set())
+        consumed.add(batch)
+        if len(consumed)==self.num_batches:
+            del self._consumed[epoch]
+        # Forget the sampling state of epochs that are done.
+        oldest = min(self._consumed.keys()) if self._consumed else self.epoch
+        for e in list(pipeline.epoch_states.keys()):
+            if e < oldest:
+                del pipeline.epoch_states[e]
+                
+    def state_dict(self):
+        '''
+        Return the position of the data_flow as a dict of picklable objects,
+        from which load_state_dict() resumes with the next batch that was
+        not yielded: the oldest epoch that is not finished (or the next
+        epoch), the batches of it (and of later epochs) that were yielded,
+        the state of the rng at the start of that epoch, and the sample
+        weights. Batches that were prefetched but not yet yielded are not
+        counted as yielded. Call between batches, or between flows.
+        '''
+        if self._resume is not None:
+            return self._resume
+        epoch = min(self._consumed.keys()) if self._consumed else self.epoch
+        pipeline = self._active_pipeline or self._pipeline
+        if pipeline is not None and epoch in pipeline.epoch_states:
+            # The epoch was sampled from this rng state, with this seed for
+            # the randomness of preprocessing.
+            rng_state, batch_seed = pipeline.epoch_states[epoch]
+            epoch_started = True
+        else:
+            # The epoch will be sampled by the next pipeline.
+            rng_state = self.rng.get_state()
+            batch_seed = None
+            epoch_started = False
+        weights = None
+        if self._weight_tree is not None:
+            weights = self._weight_tree.get_weights()
+        return {'epoch': epoch,
+                'consumed': dict([(e, sorted(b))
+                                  for e, b in self._consumed.items()]),
+                'rng_state': rng_state,
+                'batch_seed': batch_seed,
+                'epoch_started': epoch_started,
+                'weights': weights,
+                'num_batches': self.num_batches}
+                
+    def load_state_dict(self, state):
+        '''
+        Resume from a position returned by state_dict(): the next flow()
+        yields the batches of the epoch that were not yet yielded, without
+        loading the others, then carries on with the following epochs.
+        Persistent workers are restarted.
+        '''
+        if state['num_batches']!=self.num_batches:
+            raise ValueError("The state has {} batches per epoch instead of "
+                             "{}.".format(state['num_batches'],
+                                          self.num_batches))
+        if self._active_pipeline is not None:
+            raise RuntimeError("Cannot load a state while flow() is being "
+                               "iterated over.")
+        if self._pipeline is not None:
+            self._stop_pipeline(self._pipeline)
+        if state['weights'] is not None:
+            if self._weight_tree is None:
+                raise ValueError("The state has sample weights but the "
+                                 "data_flow has none.")
+            self._weight_tree = sum_tree(state['weights'])
+        self.epoch = state['epoch']
+        self._consumed = dict([(e, set(b))
+                               for e, b in state['consumed'].items()])
+        self._resume = state
+                
+    def set_epoch(self, epoch):
+        '''
+        Set the epoch that the next flow() yields, which seeds its sampling
+        order if sample_seed is set. Persistent workers that prefetched
+        another epoch are restarted.
+        '''
+        pipeline = self._pipeline
+        if pipeline is not None:
+            if pipeline.in_use:
+                raise RuntimeError("Cannot set the epoch while flow() is "
+                                   "being iterated over.")
+            if pipeline.first_epoch+pipeline.next_epoch!=epoch:
+                self._stop_pipeline(pipeline)
+        self.epoch = epoch
+        self._resume = None
         
-        # Prepare to start processes + thread.
-        load_queue = None
-        proc_queue = None
-        idx_queue = None
-        index_thread = None
-        process_list = []
-        preload_list = []
+    def close(self):
+        '''
+        Shut down the persistent worker threads and processes, if any.
+        '''
+        if self._pipeline is not None:
+            self._stop_pipeline(self._pipeline)
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
         
+    def stats(self):
+        """
+        Return a snapshot of the metrics recorded since the data_flow was
+        first iterated over (requires metrics to be enabled): for every
+        stage, the number, total and maximum duration, and bytes of each
+        kind of work it did; for every queue, its mean, maximum, and last
+        sampled depth; and the fraction of time that the consumer stalled
+        waiting for batches.
+        """
+        if self._stats is None:
+            raise ValueError("Metrics are disabled; set metrics=True.")
+        return self._stats.snapshot()
+    
+    def export_trace(self, path=None):
+        """
+        Return the most recent metrics as a Chrome trace (a dict that can be
+        loaded, once saved as JSON, in chrome://tracing or Perfetto) and
+        save it to `path`, if given. Requires metrics='trace'.
+        """
+        if self._stats is None or self._stats.events is None:
+            raise ValueError("Trace events are not recorded; set "
+                             "metrics='trace'.")
+        trace = self._stats.trace()
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+    
+    def _new_recorder(self, stage):
+        # Must be called in the thread or process that runs the stage.
+        return _new_recorder(stage, self._stats is not None)
+    
+    def _start_pipeline(self):
+        if self._stats is not None:
+            self._stats.start()
+        if self._tuner is not None:
+            self._tuner.reset()
+        pipeline = _pipeline()
+        pipeline.first_epoch = self.epoch
+        pipeline.resume = self._resume
+        self._resume = None
+        if pipeline.resume is not None:
+            # Skip the batches that were consumed before.
+            for epoch, batches in pipeline.resume['consumed'].items():
+                first_seq = (epoch-pipeline.first_epoch)*self.num_batches
+                pipeline.skipped.update([first_seq+b for b in batches])
         try:
-            # Create the queues.
-            #   NOTE: these can become corrupt on sub-process termination,
-            #   so create them in flow() and let them die with the flow().
-            q_size = max(self.nb_io_workers, self.nb_proc_workers)
-            load_queue = multiprocessing.Queue(q_size)
+            self._start_workers(pipeline)
+        except:
+            self._stop_pipeline(pipeline)
+            raise
+        if self.persistent_workers:
+            atexit.register(self.close)
+        return pipeline
+    
+    def _start_workers(self, pipeline):
+        # Create a stop event to trigger on exceptions/interrupt/termination.
+        pipeline.stop = stop = self._mp.Event()
+        
+        # Create the queues.
+        #   NOTE: these can become corrupt on sub-process termination,
+        #   so create them in flow() and let them die with the flow().
+        q_size = max(self.nb_io_workers, self.nb_proc_workers)
+        max_workers = self.nb_io_workers+self.nb_proc_workers
+        # The prefetch depth, or number of batches in flight (sampled but
+        # not yet consumed), that allows every queue to be full and every
+        # worker busy.
+        prefetch = 3*q_size+self.nb_io_workers+self.nb_proc_workers
+        if self.prefetch is not None:
+            # Size the queues to hold every batch in flight.
+            prefetch = q_size = self.prefetch
+        max_in_flight = prefetch
+        budget_slots = None
+        if self._tuner is not None and not self._tuner.done:
+            # Make room for the workers and batches in flight that may be
+            # added while tuning, within the byte budget of the batches in
+            # flight (if the size of a batch can be estimated).
+            max_in_flight = max(self._tuner.max_prefetch, prefetch)
+            if self._tuner.max_prefetch_bytes is not None:
+                try:
+                    batch_bytes = self._get_shm_slot_bytes()
+                except ValueError:
+                    batch_bytes = 0
+                if batch_bytes > 0:
+                    budget_slots = max(int(self._tuner.max_prefetch_bytes
+                                           //batch_bytes), prefetch)
+                    max_in_flight = min(max_in_flight, budget_slots)
+            q_size = max_in_flight
+            max_workers = max(self._tuner.max_workers, max_workers)
+        pipeline.max_prefetch = max_in_flight
+        if self.nb_proc_workers==0:
+            # If there are no worker processes, alias load_queue as
+            # proc_queue, allowing data to thus be yielded directly from
+            # the load_queue.
+            load_queue = proc_queue = self._mp.Queue(q_size)
+        elif self.proc_backend=='threads':
+            # Batches are passed between threads without pickling (but
+            # pickled from loader processes, if any).
+            if self.io_backend=='processes':
+                load_queue = self._mp.Queue(q_size)
+            else:
+                load_queue = queue.Queue(q_size)
+            proc_queue = queue.Queue(q_size)
+        else:
+            load_queue = self._mp.Queue(q_size)
+            proc_queue = self._mp.Queue(q_size)
+        pipeline.load_queue = load_queue
+        pipeline.proc_queue = proc_queue
+            
+        # In ordered mode, limit the number of batches in flight so as to
+        # bound the reorder buffer. With persistent workers, limit it so as
+        # to bound the batches of the next epoch that are received (and
+        # buffered) while the current epoch is consumed; these would
+        # otherwise hold every shared memory slot. Otherwise, only limit it
+        # if the prefetch depth is set or tuned.
+        in_flight = None
+        if (self.ordered or self.persistent_workers
+                or self.prefetch is not None or self._tuner is not None):
+            in_flight = threading.Semaphore(prefetch)
+            pipeline.prefetch = prefetch
+        pipeline.in_flight = in_flight
+            
+        # Create the shared memory rings, if used, with enough slots for
+        # every batch that can be queued, loaded, processed, or held by
+        # the consumer at once.
+        # (Processing threads get batches without copying.)
+        load_ring = None
+        proc_ring = None
+        if self.shared_memory and not (self.proc_backend=='threads'
+                                       and self.nb_proc_workers > 0):
+            nb_slots = q_size+max_workers+2
+            if in_flight is not None:
+                # Every batch in flight may hold a slot.
+                nb_slots = max(nb_slots, max_in_flight)
+                if budget_slots is not None:
+                    # A batch in flight holds at most one slot of each
+                    # ring, so that this many slots are enough.
+                    nb_slots = max_in_flight
+            slot_bytes = self._get_shm_slot_bytes()
+            load_ring = _shared_memory_ring(nb_slots, slot_bytes, self._mp)
+            pipeline.load_ring = load_ring
             if self.nb_proc_workers > 0:
-                proc_queue = multiprocessing.Queue(q_size)
+                proc_ring = _shared_memory_ring(nb_slots, slot_bytes,
+                                                self._mp)
             else:
-                # If there are no worker processes, alias load_queue as
-                # proc_queue, allowing data to thus be yielded directly from
-                # the load_queue.
-                proc_queue = load_queue
-            
-            # Start the parallel data processing proccess(es)
-            seed_base = self.rng.randint(self.nb_proc_workers, 2**16)
-            for i in range(self.nb_proc_workers):
-                pseed = seed_base - i
-                process_thread = multiprocessing.Process( \
-                    target=self._process_subroutine,
-                    args=(load_queue, proc_queue, stop, pseed))
-                process_thread.daemon = True
-                process_thread.start()
-                process_list.append(process_thread)
-                
-            # Start the data index provider thread.
-            idx_queue = queue.Queue(q_size)
-            index_thread = threading.Thread( \
-                target=self._index_provider,
-                args=(idx_queue, stop) )
-            index_thread.daemon = True
-            index_thread.start()
-                
-            # Start the parallel loader thread.
-            # (must be started AFTER processes to avoid copying it in fork())
-            for i in range(self.nb_io_workers):
-                preload_thread = threading.Thread( \
-                    target=self._preload_subroutine,
-                    args=(load_queue, idx_queue, stop) )
-                preload_thread.daemon = True
-                preload_thread.start()
-                preload_list.append(preload_thread)
+                proc_ring = load_ring
+            pipeline.proc_ring = proc_ring
             
-            # Yield batches fetched from the parallel process(es).
-            nb_yielded = 0
-            while not stop.is_set():
-                try:
-                    if not self.loop_forever and nb_yielded==self.num_batches:
-                        stop.set()
+        # Draw the seeds for all workers at once, before the index
+        # provider starts using the rng, so that the sampling order does
+        # not depend on the number of workers. When resuming, restore the
+        # rng state in which the epoch was (or would have been) sampled.
+        resume = pipeline.resume
+        if resume is not None and not resume['epoch_started']:
+            self.rng.set_state(resume['rng_state'])
+        pipeline.seed_base = self.rng.randint(2**31)
+        pipeline.batch_seed = self.rng.randint(2**31)
+        if resume is not None and resume['epoch_started']:
+            self.rng.set_state(resume['rng_state'])
+            pipeline.batch_seed = resume['batch_seed']
+        
+        # Start the parallel data processing proccess(es)
+        pipeline.process_lock = threading.Lock()
+        for i in range(self.nb_proc_workers):
+            self._start_process(pipeline)
+            
+        # Create the queue of batch indices, which loader processes get
+        # from.
+        if self.io_backend=='processes':
+            pipeline.idx_queue = idx_queue = self._mp.Queue(q_size)
+        else:
+            pipeline.idx_queue = idx_queue = queue.Queue(q_size)
+        
+        # Stacked batches are read into recycled buffers. A buffer cannot
+        # be reused until the batch is copied out of it, which is done
+        # asynchronously after a batch is put in the load_queue; however,
+        # the batch must have been taken out of the queue (and thus
+        # copied) once q_size more batches have been put in it.
+        # (Every loader process gets a pool of its own.)
+        # A queue.Queue passes batches on to processing threads without
+        # copying them, so that they may be held by a processing thread or
+        # the consumer for any time: their buffers are then not recycled.
+        if self.stack_batches:
+            lag = q_size
+            if isinstance(load_queue, queue.Queue):
+                lag = None
+            pipeline.buffer_pool = _buffer_pool(lag=lag)
+            
+        # Clear the sample cache if it holds the outputs of another version
+        # of cache_fn.
+        if self.cache_fn is not None:
+            self.sample_cache.open(self.cache_version, self.data_length,
+                                   self._compute_sample)
+            
+        # Start the parallel loader thread.
+        # (must be started AFTER processes to avoid copying it in fork())
+        pipeline.loader = _batch_loader(self.data, self._processor,
+                                        preprocess=(self.nb_proc_workers==0),
+                                        cache_fn=self.cache_fn,
+                                        sample_cache=self.sample_cache,
+                                        stack_batches=self.stack_batches)
+        for i in range(self.nb_io_workers):
+            self._start_preload_thread(pipeline)
+            
+        # Start the data index provider thread, once all processes are
+        # started.
+        index_thread = threading.Thread( \
+            target=self._index_provider,
+            args=(idx_queue, stop, in_flight, pipeline) )
+        index_thread.daemon = True
+        index_thread.start()
+        pipeline.index_thread = index_thread
+            
+    def _compute_sample(self, index):
+        return self.cache_fn([d[index] for d in self.data])
+            
+    def _next_seed(self, pipeline):
+        # A distinct seed for every worker of the pipeline.
+        return (pipeline.seed_base+len(pipeline.process_list)
+                +len(pipeline.preload_list))
+            
+    def _start_process(self, pipeline):
+        # Start a processing worker: a process or, with the 'threads'
+        # backend, a thread.
+        args = (self._processor, pipeline.load_queue, pipeline.proc_queue,
+                pipeline.stop, self._next_seed(pipeline), pipeline.batch_seed,
+                pipeline.load_ring, pipeline.proc_ring)
+        if self.proc_backend=='threads':
+            process_thread = threading.Thread( \
+                target=_process_subroutine,
+                args=args+(pipeline.process_lock,))
+        else:
+            process_thread = self._mp.Process( \
+                target=_process_subroutine,
+                args=args)
+        process_thread.daemon = True
+        process_thread.start()
+        pipeline.process_list.append(process_thread)
+        
+    def _start_preload_thread(self, pipeline):
+        # Start a loader: a thread or, with the 'processes' io_backend, a
+        # process.
+        args = (pipeline.loader, pipeline.load_queue, pipeline.idx_queue,
+                pipeline.stop, pipeline.load_ring, self._next_seed(pipeline),
+                pipeline.batch_seed)
+        if self.io_backend=='processes':
+            preload_thread = self._mp.Process( \
+                target=_preload_subroutine,
+                args=args+(None, pipeline.buffer_pool))
+        else:
+            preload_thread = threading.Thread( \
+                target=_preload_subroutine,
+                args=args+(pipeline.process_lock, pipeline.buffer_pool))
+        preload_thread.daemon = True
+        preload_thread.start()
+        pipeline.preload_list.append(preload_thread)
+            
+    def _stop_pipeline(self, pipeline):
+        # Set termination event, wait for all threads and processes to
+        # exit, then close queues.
+        if self._pipeline is pipeline:
+            self._pipeline = None
+            atexit.unregister(self.close)
+        if pipeline.stop is None:
+            return
+        pipeline.stop.set()
+        idx_queue = pipeline.idx_queue
+        load_queue = pipeline.load_queue
+        proc_queue = pipeline.proc_queue
+        workers = [w for w in [pipeline.index_thread]+pipeline.preload_list
+                                                      +pipeline.process_list
+                   if w is not None]
+        rings = set([r for r in [pipeline.load_ring, pipeline.proc_ring]
+                     if r is not None])
+        for ring in rings:
+            # Wake up any stage waiting for a free slot. The free slot
+            # queues are never drained, so this is done only once.
+            for i in range(len(pipeline.preload_list)
+                           +len(pipeline.process_list)):
+                ring.free_slots.put(None)
+        while any([w.is_alive() for w in workers]):
+            # Wake up every stage that is blocked on a queue: drain the
+            # queues to unblock puts and send a sentinel (None) to each
+            # live stage that may be waiting to get an item. Sentinels
+            # stop being sent once their receivers have exited, so that
+            # they cannot keep the queues full.
+            for q in set([idx_queue, load_queue, proc_queue]):
+                if q is not None:
+                    _drain(q)
+            for q, receivers in [(idx_queue, pipeline.preload_list),
+                                 (load_queue, pipeline.process_list)]:
+                for w in receivers:
+                    if not w.is_alive():
+                        continue
+                    try:
+                        q.put_nowait(None)
+                    except queue.Full:
                         break
-                    batch = proc_queue.get()
-                    yield batch
-                    nb_yielded += 1
-                except:
-                    stop.set()
-                    raise
-        except:
-            stop.set()
-            raise
-        finally:
-            # Clean up, whether there was an exception or not.
-            #
-            # Set termination event, wait for all threads and processes to
-            # exit, then close queues.
-            stop.set()
-            index_thread.join()
-            for thread in preload_list:
-                thread.join()
-            for process in process_list:
-                process.join()
-            if self.nb_proc_workers and proc_queue is not None:
-                # If nb_proc_workers==0, proc_queue is just an alias to
-                # load_queue
-                proc_queue.close()
-            if load_queue is not None:
-                load_queue.close()
+            if (pipeline.in_flight is not None
+                    and pipeline.index_thread is not None
+                    and pipeline.index_thread.is_alive()):
+                pipeline.in_flight.release()
+            for w in workers:
+                w.join(timeout=0.01)
+        if proc_queue is not load_queue and hasattr(proc_queue, 'close'):
+            # If nb_proc_workers==0, proc_queue is just an alias to
+            # load_queue
+            proc_queue.close()
+        for q in set([idx_queue, load_queue]):
+            if q is not None and hasattr(q, 'close'):
+                # Every reader has exited, so whatever is still buffered in
+                # the queue will never be read; do not let its feeder
+                # thread block interpreter exit trying to flush it.
+                q.cancel_join_thread()
+                q.close()
+        pipeline.buffered.clear()
+        with pipeline._lock:
+            pipeline.closed = True
+        for ring in rings:
+            ring.close()
+            
+    def _get_batch(self, pipeline, first_seq, end_seq):
+        # Return the (meta, payload) of a batch with a sequence number in
+        # [first_seq, end_seq), or in [first_seq, inf) if end_seq is None.
+        # Batches that come earlier are dropped; batches that come later are
+        # kept for later.
+        def wanted(seq):
+            return seq >= first_seq and (end_seq is None or seq < end_seq)
+        for seq in sorted(pipeline.buffered.keys()):
+            if wanted(seq):
+                return pipeline.buffered.pop(seq)
+        while True:
+            meta, payload = self._get_item(pipeline.proc_queue,
+                                           pipeline.process_list
+                                           +pipeline.preload_list)
+            if wanted(meta['seq']):
+                return meta, payload
+            if meta['seq'] < first_seq:
+                pipeline.discard(payload)
+            else:
+                pipeline.buffered[meta['seq']] = (meta, payload)
+    
+    def _get_item(self, proc_queue, worker_list):
+        # Block until an item is ready. Wake up periodically only to check
+        # that no worker process has died, which would otherwise leave the
+        # consumer waiting forever. Re-raise exceptions from any stage.
+        while True:
+            try:
+                item = proc_queue.get(timeout=1)
+                if isinstance(item, _stage_error):
+                    item.reraise()
+                return item
+            except queue.Empty:
+                for process in worker_list:
+                    # (Threads have no exit code.)
+                    if getattr(process, 'exitcode', None) not in (None, 0):
+                        raise RuntimeError("A data_flow worker process "
+                                           "exited unexpectedly with exit "
+                                           "code {}.".format(process.exitcode))
+                                           
+    def _get_shm_slot_bytes(self):
+        if self.shm_slot_bytes is not None:
+            return self.shm_slot_bytes
+        slot_bytes = 0
+        for d in self.data:
+            shape = getattr(d, 'shape', None)
+            dtype = getattr(d, 'dtype', None)
+            if shape is None or dtype is None:
+                raise ValueError("Cannot determine the size of a batch for "
+                                 "shared memory transport: data arrays have "
+                                 "no shape or dtype. Set shm_slot_bytes.")
+            elem_bytes = int(np.prod(shape[1:]))*np.dtype(dtype).itemsize
+            elem_bytes += _shared_memory_ring.align
+            slot_bytes += self.batch_size*elem_bytes
+        return slot_bytes
                 
-    ''' Generate the indices to for each batch of data. '''
-    def _index_provider(self, idx_queue, stop):
+    ''' Generate the indices to for each batch of data, tagged with the
+        sequence number of the batch, the epoch, and the index of the batch in
+        the epoch. '''
+    def _index_provider(self, idx_queue, stop, in_flight, pipeline):
+        try:
+            self._provide_indices(idx_queue, stop, in_flight, pipeline)
+        except Exception as e:
+            idx_queue.put(_stage_error(e))
+            
+    def _provide_indices(self, idx_queue, stop, in_flight, pipeline):
+        rec = self._new_recorder('index')
+        # Sequence numbers count from the start of the pipeline, whereas
+        # epochs count from the first one among all flows.
+        first_epoch = pipeline.first_epoch
+        epoch = 0
         while not stop.is_set():
+            # Keep the state from which the epoch is sampled, for
+            # state_dict().
+            pipeline.epoch_states[first_epoch+epoch] = (self.rng.get_state(),
+                                                        pipeline.batch_seed)
+            
             # Initialize index sampler at start of epoch.
-            sampler = iter(\
-                index_sampler(array_length=self.num_samples,
-                              random=self.sample_random,
-                              replacement=self.sample_with_replacement,
-                              weights=self.sample_weights,
-                              rng=self.rng))
+            sampler = index_sampler(array_length=self.data_length,
+                                    random=self.sample_random,
+                                    replacement=self.sample_with_replacement,
+                                    weights=self._weight_tree,
+                                    rng=self.rng,
+                                    block_size=self.sample_block_size,
+                                    block_window=self.sample_block_window,
+                                    rank=self.rank,
+                                    world_size=self.world_size,
+                                    pad=self.pad_shards,
+                                    seed=self.sample_seed,
+                                    epoch=first_epoch+epoch)
             
             # Loop batchwise over the dataset.
-            for b in range(self.num_batches):
-                bs = min(self.batch_size,
-                            self.num_samples-b*self.batch_size)
-                if self.drop_incomplete_batches and bs < self.batch_size:
+            t = rec.clock()
+            for b, batch_indices in enumerate(\
+                                        sampler.iter_batches(self.batch_size)):
+                if (self.drop_incomplete_batches
+                        and len(batch_indices) < self.batch_size):
                     continue
-                try:
-                    batch_indices = [next(sampler) for _ in range(bs)]
-                except:
-                    stop.set()
-                    raise()
-                put_successful = False
-                while not put_successful:
-                    try:
-                        idx_queue.put(batch_indices, timeout=0.001)
-                        put_successful = True
-                    except queue.Full:
-                        put_successful=False
-                    except:
-                        stop.set()
-                        raise
+                seq = epoch*self.num_batches+b
+                if seq in pipeline.skipped:
+                    continue
+                rec.record('sample', t)
+                t = rec.clock()
+                if in_flight is not None:
+                    in_flight.acquire()
                     if stop.is_set(): return
-            if not self.loop_forever:
+                meta = {'seq': seq, 'epoch': first_epoch+epoch, 'batch': b}
+                rec.attach(meta)
+                idx_queue.put((meta, batch_indices))
+                rec.record('put_wait', t)
+                if stop.is_set(): return
+                t = rec.clock()
+            if not self.loop_forever and not self.persistent_workers:
                 return
+            epoch += 1
             
-    ''' Preload batches in the background and add them into the load_queue.
-        Wait if the queue is full. '''
-    def _preload_subroutine(self, load_queue, idx_queue, stop):
+    def update_weights(self, indices, values):
+        """
+        Set the sample weights of the elements at `indices` to `values`. This
+        is safe to call while flow() is running. When sampling with
+        replacement, batches sampled from then on use the new weights; when
+        sampling without replacement, the next epoch does.
+        """
+        if self._weight_tree is None:
+            raise ValueError("Weights can only be updated when sampling with "
+                             "sample_weights.")
+        values = np.asarray(values, dtype=np.float64)
+        if not self.sample_with_replacement and np.any(values==0):
+            raise ValueError("When sampling without replacement, sample "
+                             "weights must never be zero.")
+        self._weight_tree.update(indices, values)
+            
+    def __len__(self):
+        return self.num_batches
+
+
+def _preload_subroutine(loader, load_queue, idx_queue, stop, load_ring, seed,
+                        batch_seed, process_lock=None, buffer_pool=None):
+    """
+    Preload batches in the background and add them into the load_queue.
+    Wait if the queue is full. Runs in a thread or, if process_lock is not
+    given, in a process of its own, which reopens the data.
+    """
+    rng = np.random.RandomState(seed)
+    in_process = process_lock is None
+    if in_process:
+        # The global numpy random state is only seeded in a process;
+        # threads share it.
+        np.random.seed(seed)
+        process_lock = threading.Lock()
+        loader = loader.reopen()
+    rec = loader.new_recorder('loader')
+    try:
         while not stop.is_set():
-            batch_indices = None
-            while batch_indices is None:
-                try:
-                    batch_indices = idx_queue.get(timeout=0.001)
-                except queue.Empty:
-                    pass
-                except:
-                    stop.set()
-                    raise
-                if stop.is_set(): return
+            # Block until indices are available or until woken up by a
+            # sentinel (None) on shutdown.
+            t = rec.clock()
+            item = idx_queue.get()
+            if item is None or stop.is_set(): return
+            if isinstance(item, _stage_error):
+                load_queue.put(item)
+                return
+            meta, batch_indices = item
+            rec.record('get_wait', t)
             # Assuming that if the user chose to have more than one loader
             # thread, data access is known to be threadsafe.
-            batch = []
-            for d in self.data:
-                batch.append([d[int(i)] for i in batch_indices])
-            if self.nb_proc_workers==0:
+            t = rec.clock()
+            if loader.cache_fn is not None:
+                batch = loader.load_cached_batch(batch_indices, rec)
+                buffers = []
+            else:
+                batch, buffers = loader.load_batch(batch_indices, buffer_pool)
+                rec.record('read', t, batch)
+            if loader.preprocess:
                 # If there are no worker processes, preprocess the batch
-                # in the loader thread.
-                try:
-                    batch = self._process_batch(batch)
-                except:
-                    stop.set()
-                    raise
-                if stop.is_set(): return
-            put_successful = False
-            while not put_successful:
-                # Poll to allow graceful termination.
-                try:
-                    load_queue.put(batch, timeout=0.001)
-                    put_successful = True
-                except queue.Full:
-                    put_successful = False
-                except:
-                    stop.set()
-                    raise
-                if stop.is_set(): return
-                
-    ''' Process any loaded batches in the load queue and add them to the
-        processed queue -- these are ready to yield. '''
-    def _process_subroutine(self, load_queue, proc_queue, stop, seed):
+                # in the loader.
+                t = rec.clock()
+                batch = loader.processor.preprocess(batch, meta, rng,
+                                                    batch_seed, process_lock)
+                rec.record('preprocess', t, batch)
+            t = rec.clock()
+            payload = _prepare_batch(batch, load_ring)
+            if payload is None or stop.is_set(): return
+            copied = load_ring is not None and payload[0] is not None
+            if copied:
+                rec.record('transport', t, batch)
+            if buffers and copied:
+                # The batch was copied into shared memory.
+                buffer_pool.release(buffers)
+                buffers = None
+            rec.attach(meta)
+            t = rec.clock()
+            load_queue.put((meta, payload))
+            rec.record('put_wait', t)
+            if buffers:
+                buffer_pool.release_after_puts(buffers)
+    except Exception as e:
+        # Pass the exception on to be re-raised by the consumer.
+        load_queue.put(_stage_error(e))
+    finally:
+        if in_process and load_ring is not None:
+            # Do not wait to flush released slots on exit (see
+            # _process_subroutine).
+            load_ring.free_slots.cancel_join_thread()
+
+
+def _process_subroutine(processor, load_queue, proc_queue, stop, seed,
+                        batch_seed, load_ring=None, proc_ring=None,
+                        process_lock=None):
+    """
+    Process any loaded batches in the load queue and add them to the
+    processed queue -- these are ready to yield. Runs in a process of its own
+    or, if process_lock is given, in a thread.
+    """
+    rng = np.random.RandomState(seed)
+    if process_lock is None:
+        # The global numpy random state is only seeded in a process;
+        # threads share it.
         np.random.seed(seed)
+        process_lock = threading.Lock()
+    rec = processor.new_recorder('processor')
+    try:
+        while not stop.is_set():
+            # Block until a batch is available or until woken up by a
+            # sentinel (None) on shutdown.
+            t = rec.clock()
+            item = load_queue.get()
+            if item is None or stop.is_set(): break
+            if isinstance(item, _stage_error):
+                proc_queue.put(item)
+                return
+            meta, payload = item
+            rec.record('get_wait', t)
+            batch, slot = _receive_batch(payload, load_ring)
+            t = rec.clock()
+            batch_processed = processor.preprocess(batch, meta, rng,
+                                                   batch_seed,
+                                                   process_lock)
+            rec.record('preprocess', t, batch_processed)
+            t = rec.clock()
+            payload = _prepare_batch(batch_processed, proc_ring)
+            if proc_ring is not None and payload is not None \
+                                     and payload[0] is not None:
+                rec.record('transport', t, batch_processed)
+            del batch, batch_processed
+            if slot is not None:
+                load_ring.release(slot)
+            if payload is None or stop.is_set(): break
+            rec.attach(meta)
+            t = rec.clock()
+            proc_queue.put((meta, payload))
+            rec.record('put_wait', t)
+    except Exception as e:
+        # Pass the exception on to be re-raised by the consumer.
+        proc_queue.put(_stage_error(e))
+    finally:
+        # Do not wait to flush released slots on exit: the free slot
+        # queues are never drained on shutdown. (Items put in the other
+        # queues are flushed on exit; the consumer drains them until all
+        # processes have exited. Dropping them instead would leave them
+        # counted against the queue size, blocking other processes.)
+        for ring in set([load_ring, proc_ring]):
+            if ring is not None:
+                ring.free_slots.cancel_join_thread()
+
+
+class _batch_processor(object):
+    """
+    Preprocesses batches in the stages of a data_flow. It only holds what is
+    needed to do so, in order to be picklable for processes started with
+    'spawn' or 'forkserver' (if the preprocessor is picklable).
+    
+    process_batch : the preprocessor
+    ordered : whether to seed the randomness used to preprocess each batch
+        from the batch seed, the epoch, and the index of the batch
+    metrics : whether to record metrics
+    """
+    def __init__(self, process_batch, ordered, metrics):
+        self.process_batch = process_batch
+        self.takes_rng = _takes_rng(process_batch)
+        self.ordered = ordered
+        self.metrics = metrics
+        
+    def new_recorder(self, stage):
+        return _new_recorder(stage, self.metrics)
+    
+    def preprocess(self, batch, meta, rng, batch_seed, process_lock):
+        if self.ordered:
+            # Seed the randomness from the epoch and the index of the batch
+            # in the epoch so that it does not depend on the worker.
+            seed = [batch_seed, meta['epoch'], meta['batch']]
+            rng = np.random.RandomState(seed)
+        if self.takes_rng:
+            return self.process_batch(batch, rng=rng)
+        if not self.ordered:
+            return self.process_batch(batch)
+        # The global numpy random state is shared by all threads.
+        with process_lock:
+            np.random.seed(seed)
+            return self.process_batch(batch)
+
+
+class _batch_loader(object):
+    """
+    Loads (and, if there are no processing workers, preprocesses) batches in
+    the loaders of a data_flow. As with _batch_processor, it only holds what
+    is needed to do so, in order to be picklable for loader processes started
+    with 'spawn' or 'forkserver' (if the data is picklable).
+    
+    data : the list of data arrays
+    processor : the _batch_processor of the data_flow
+    preprocess : whether to preprocess batches after loading them
+    cache_fn : the cache_fn of the data_flow, if any
+    sample_cache : the sample_cache of the data_flow
+    stack_batches : whether to stack cached outputs that are arrays
+    """
+    def __init__(self, data, processor, preprocess, cache_fn=None,
+                 sample_cache=None, stack_batches=False):
+        self.data = data
+        self.processor = processor
+        self.preprocess = preprocess
+        self.cache_fn = cache_fn
+        self.sample_cache = sample_cache
+        self.stack_batches = stack_batches
+        
+    def new_recorder(self, stage):
+        return self.processor.new_recorder(stage)
+    
+    def reopen(self):
+        # Reopen the data in a loader process, rather than using file
+        # handles inherited from the data_flow.
+        return _batch_loader([_reopen(d) for d in self.data], self.processor,
+                             self.preprocess, self.cache_fn,
+                             self.sample_cache, self.stack_batches)
+        
+    def load_batch(self, batch_indices, buffer_pool):
+        # Return the batch and the buffers from the pool that it uses.
+        if buffer_pool is None:
+            batch = [[d[int(i)] for i in batch_indices] for d in self.data]
+            return batch, []
+        indices = np.asarray(batch_indices, dtype=np.int64)
+        batch = []
+        buffers = []
+        for d in self.data:
+            if not _is_array_like(d):
+                batch.append([d[int(i)] for i in indices])
+                continue
+            buf = buffer_pool.get((len(indices),)+tuple(d.shape[1:]), d.dtype)
+            if isinstance(d, delayed_view):
+                # Indexing the view is already done in bulk.
+                buf[...] = d[indices]
+            else:
+                _gather(d, indices, out=buf)
+            batch.append(buf)
+            buffers.append(buf)
+        return batch, buffers
+    
+    def load_cached_batch(self, batch_indices, rec):
+        # Return the batch of the outputs of cache_fn for the samples at
+        # batch_indices, reading and computing only those that are not
+        # cached.
+        t = rec.clock()
+        outputs = [self.sample_cache.get(int(i)) for i in batch_indices]
+        missing = [j for j, o in enumerate(outputs) if o is None]
+        rec.record('cache_get', t)
+        if missing:
+            t = rec.clock()
+            samples = [[d[int(batch_indices[j])] for d in self.data]
+                       for j in missing]
+            rec.record('read', t, samples)
+            t = rec.clock()
+            for j, sample in zip(missing, samples):
+                outputs[j] = tuple(self.cache_fn(sample))
+                self.sample_cache.put(int(batch_indices[j]), outputs[j])
+            rec.record('cache_fn', t, [outputs[j] for j in missing])
+        batch = []
+        for k in range(len(outputs[0])):
+            items = [o[k] for o in outputs]
+            if self.stack_batches and _is_array_like(items[0]):
+                items = np.stack(items)
+            batch.append(items)
+        return batch
+
+
+class _pipeline(object):
+    """
+    The queues, workers, and consumer state of a running data_flow.
+    """
+    def __init__(self):
+        self.stop = None
+        self.idx_queue = None
+        self.load_queue = None
+        self.proc_queue = None
+        self.load_ring = None
+        self.proc_ring = None
+        self.in_flight = None
+        self.prefetch = None    # The limit of in_flight, if any.
+        self.max_prefetch = None    # What prefetch may be tuned up to.
+        self.seed_base = None
+        self.batch_seed = None
+        self.buffer_pool = None
+        self.loader = None
+        self.process_lock = None
+        self.index_thread = None
+        self.preload_list = []
+        self.process_list = []
+        self.in_use = False
+        self.first_epoch = 0    # The epoch of the data_flow at the start.
+        self.next_epoch = 0
+        self.resume = None      # The state that the pipeline resumes from.
+        self.skipped = set()    # Sequence numbers of batches not sampled.
+        self.epoch_states = {}  # {epoch: (rng state, batch_seed)}
+        self.buffered = {}      # Batches received ahead of time, by seq.
+        self.closed = False
+        self._lock = threading.Lock()
+        
+    def release(self, slot):
+        # Release the resources held by a consumed batch. Batches may be
+        # released after the pipeline is closed (eg. by aflow() consumers).
+        with self._lock:
+            if self.closed:
+                return
+            if slot is not None:
+                self.proc_ring.release(slot)
+            if self.in_flight is not None:
+                self.in_flight.release()
+            
+    def discard(self, payload):
+        slot = None
+        if self.proc_ring is not None:
+            slot = payload[0]
+        self.release(slot)
+        
+    def drop_stale(self, first_seq):
+        for seq in list(self.buffered.keys()):
+            if seq < first_seq:
+                self.discard(self.buffered.pop(seq)[1])
+                
+    def get_queue_depths(self):
+        # Return {name: (depth, capacity)} for every queue whose depth is
+        # known; multiprocessing queues have no qsize() on some platforms.
+        queues = [('idx_queue', self.idx_queue),
+                  ('load_queue', self.load_queue)]
+        if self.proc_queue is not self.load_queue:
+            queues.append(('proc_queue', self.proc_queue))
+        depths = {}
+        for name, q in queues:
+            if q is None:
+                continue
+            try:
+                depth = q.qsize()
+            except NotImplementedError:
+                continue
+            # The maximum size of a queue.Queue or multiprocessing.Queue.
+            capacity = getattr(q, 'maxsize', getattr(q, '_maxsize', None))
+            depths[name] = (depth, capacity)
+        depths['reorder_buffer'] = (len(self.buffered), None)
+        return depths
+
+
+class _async_pump(object):
+    """
+    Runs a data_flow in a thread, handing its batches to the asynchronous
+    consumers of aflow() through an asyncio.Queue of (kind, value) items:
+    ('batch', (batch, release)), ('error', exception), or ('end', None).
+    
+    batches  : the data_flow._flow() generator to run
+    loop     : the event loop of the consumers
+    prefetch : the maximum number of batches waiting for a consumer
+    """
+    def __init__(self, batches, loop, prefetch):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.free_slots = threading.Semaphore(prefetch)
+        self.stop = threading.Event()
+        self.nb_consumers = 0
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, args=(batches,))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def _run(self, batches):
+        end = ('end', None)
         try:
-            while not stop.is_set():
-                batch = None
-                while batch is None:
-                    # Poll to allow graceful termination.
-                    try:
-                        batch = load_queue.get(timeout=0.001)
-                    except queue.Empty:
-                        pass
-                    except:
-                        stop.set()
-                        raise
-                    if stop.is_set(): return
+            while True:
+                # Wait for room before getting the next batch, so that
+                # batches are not released before they are consumed.
+                self.free_slots.acquire()
+                if self.stop.is_set():
+                    break
                 try:
-                    batch_processed = self._process_batch(batch)
-                except:
-                    stop.set()
-                    raise
-                if stop.is_set(): return
-                put_successful = False
-                while not put_successful:
-                    # Poll to allow graceful termination.
-                    try:
-                        proc_queue.put(batch_processed, timeout=0.001)
-                        put_successful = True
-                    except queue.Full:
-                        put_successful = False
-                    except:
-                        stop.set()
-                        raise
-                    if stop.is_set(): return
-        except:
-            stop.set()
-            load_queue.cancel_join_thread()
-            proc_queue.cancel_join_thread()
-            raise
+                    item = next(batches)
+                except StopIteration:
+                    break
+                self._put(('batch', item))
+        except Exception as e:
+            end = ('error', e)
+        finally:
+            # Stops the flow, unless its workers are persistent.
+            batches.close()
+            self._put(end)
             
-    def __len__(self):
-        return self.num_batches
+    def _put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed.
+            if item[0]=='batch':
+                item[1][1]()
+            
+    async def close(self):
+        self.stop.set()
+        self.free_slots.release()
+        await self.loop.run_in_executor(None, self.thread.join)
+        # Release the batches that were never consumed.
+        while not self.queue.empty():
+            kind, value = self.queue.get_nowait()
+            if kind=='batch':
+                value[1]()
+
+
+class _autotuner(object):
+    """
+    Tunes the number of loader threads and processing processes and the
+    prefetch depth of a running data_flow. The metrics recorded over every
+    window of batches show whether the consumer stalled waiting for batches
+    and how busy the workers of each stage were. While the consumer stalls,
+    a worker is added to the busiest stage if it is saturated, or else the
+    prefetch depth is increased. A stage to which adding a worker did not
+    increase throughput is not grown further, nor is a stage of processes
+    started with the 'fork' start method.
+    
+    window : the number of batches in a window
+    max_workers : the maximum total number of loader threads and processing
+        processes
+    max_prefetch_bytes : the maximum size, in bytes, of the batches in
+        flight, or None
+    """
+    target_stall_fraction = 0.05    # Of the consumer's time.
+    saturated_fraction = 0.75       # Of the time of the workers of a stage.
+    min_speedup = 1.05              # From adding a worker to a stage.
+    max_steps = 64
+    
+    def __init__(self, window, max_workers, max_prefetch_bytes):
+        self.window = window
+        self.max_workers = max_workers
+        self.max_prefetch = 4*max_workers
+        self.max_prefetch_bytes = max_prefetch_bytes
+        self.done = False
+        self.nb_steps = 0
+        self._saturated = set()     # Stages that are not grown further.
+        self.reset()
+        
+    def reset(self):
+        # Start measuring anew, as for a new pipeline.
+        self._nb_batches = 0
+        self._last = None
+        self._grown = None          # (stage, throughput) of the last step.
+        
+    def step(self, flow, pipeline):
+        # Called by the consumer after every batch.
+        if self.done:
+            return
+        self._nb_batches += 1
+        if self._nb_batches%self.window:
+            return
+        snapshot = flow._stats.snapshot()
+        last = self._last
+        self._last = snapshot
+        if last is None:
+            # The first window only warms up the pipeline.
+            return
+        
+        def seconds(stage, names):
+            # The time spent by a stage on some kinds of work in the window.
+            def total(s):
+                work = s['stages'].get(stage, {})
+                return sum([work[n]['seconds'] for n in names if n in work])
+            return total(snapshot)-total(last)
+        
+        elapsed = snapshot['elapsed_seconds']-last['elapsed_seconds']
+        throughput = (snapshot['batches']-last['batches'])/elapsed
+        if self._grown is not None:
+            stage, previous_throughput = self._grown
+            if throughput < self.min_speedup*previous_throughput:
+                self._saturated.add(stage)
+            self._grown = None
+        stall = seconds('consumer', ['stall'])
+        busy = seconds('consumer', ['busy'])
+        if stall <= self.target_stall_fraction*(stall+busy):
+            self._finish(flow, pipeline, "the consumer no longer stalls")
+            return
+        self.nb_steps += 1
+        
+        # The fraction of the time that the workers of each stage worked.
+        nb_loaders = len(pipeline.preload_list)
+        nb_processors = len(pipeline.process_list)
+        usage = {}
+        usage['loader'] = seconds('loader', ['read', 'preprocess',
+                                             'transport'])/(nb_loaders*elapsed)
+        if nb_processors:
+            usage['processor'] = seconds('processor', ['preprocess',
+                                   'transport'])/(nb_processors*elapsed)
+        stage = max(usage.keys(), key=lambda k: usage[k])
+        if not self._can_grow(flow, stage):
+            self._saturated.add(stage)
+        if (usage[stage] >= self.saturated_fraction
+                and stage not in self._saturated
+                and nb_loaders+nb_processors < self.max_workers):
+            if stage=='processor':
+                flow._start_process(pipeline)
+                flow.nb_proc_workers += 1
+            else:
+                flow._start_preload_thread(pipeline)
+                flow.nb_io_workers += 1
+            self._grown = (stage, throughput)
+            # Give the new worker batches to work on.
+            self._grow_prefetch(flow, pipeline, 2, snapshot)
+        elif not self._grow_prefetch(flow, pipeline,
+                                     max(pipeline.prefetch//2, 1), snapshot):
+            self._finish(flow, pipeline, "the budgets are reached")
+            return
+        if self.nb_steps >= self.max_steps:
+            self._finish(flow, pipeline, "the maximum number of steps is "
+                                         "reached")
+            
+    def _can_grow(self, flow, stage):
+        # Workers run in processes are not added to a running pipeline with
+        # the 'fork' start method, which would fork this process while its
+        # threads (eg. the index provider) may hold locks.
+        if stage=='processor':
+            in_processes = flow.proc_backend=='processes'
+        else:
+            in_processes = flow.io_backend=='processes'
+        return not (in_processes and flow._mp.get_start_method()=='fork')
+    
+    def _grow_prefetch(self, flow, pipeline, n, snapshot):
+        # Allow n more batches in flight, within the budgets. Returns
+        # whether the prefetch depth could be increased.
+        n = min(n, pipeline.max_prefetch-pipeline.prefetch)
+        if self.max_prefetch_bytes is not None:
+            batch_bytes = 0
+            for stage, names in snapshot['stages'].items():
+                for name in ('read', 'preprocess'):
+                    if name in names:
+                        batch_bytes = max(batch_bytes, names[name]['bytes']
+                                                       /names[name]['count'])
+            if batch_bytes > 0:
+                n = min(n, int(self.max_prefetch_bytes//batch_bytes)
+                           -pipeline.prefetch)
+        if n <= 0:
+            return False
+        pipeline.prefetch += n
+        for i in range(n):
+            pipeline.in_flight.release()
+        flow.prefetch = pipeline.prefetch
+        return True
+    
+    def _finish(self, flow, pipeline, reason):
+        self.done = True
+        flow.prefetch = pipeline.prefetch
+        logger.info("data_flow autotuning done ({}): nb_io_workers={}, "
+                    "nb_proc_workers={}, prefetch={}"
+                    "".format(reason, flow.nb_io_workers,
+                              flow.nb_proc_workers, flow.prefetch))
+
+
+class _span_recorder(object):
+    """
+    Records the spans of time during which a stage of a data_flow (a thread
+    or process) does some kind of work, along with the bytes it moves. The
+    spans are passed down the pipeline in the meta of a batch: attach() adds
+    the spans recorded so far to the next batch that the stage passes on.
+    
+    stage : the name of the stage
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.spans = []
+    
+    def clock(self):
+        return time.time()
+    
+    def record(self, name, start, batch=None):
+        nbytes = _nbytes(batch) if batch is not None else 0
+        self.spans.append((self.stage, name, self.pid, self.tid, start,
+                           time.time(), nbytes))
+    
+    def attach(self, meta):
+        if self.spans:
+            meta['spans'] = meta.get('spans', [])+self.spans
+            self.spans = []
+
+
+class _no_recorder(object):
+    """
+    Stands in for a _span_recorder when metrics are disabled.
+    """
+    def clock(self):
+        return 0
+    
+    def record(self, name, start, batch=None):
+        pass
+    
+    def attach(self, meta):
+        pass
+
+
+class _flow_stats(object):
+    """
+    Aggregates the spans recorded by the stages of a data_flow and the
+    sampled depths of its queues. All methods are threadsafe.
+    
+    trace : if True, also keep the most recent spans and queue depths as
+        trace events
+    """
+    max_trace_events = 10**6
+    
+    def __init__(self, trace=False):
+        self.events = None
+        if trace:
+            self.events = deque(maxlen=self.max_trace_events)
+        self.start_time = None
+        self.nb_batches = 0
+        self._spans = {}    # {stage: {name: [count, seconds, max, bytes]}}
+        self._queues = {}   # {name: [nb_samples, sum, max, last, capacity]}
+        self._threads = {}  # {(pid, tid): stage}
+        self._lock = threading.Lock()
+    
+    def start(self):
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+    
+    def add_batch(self, meta, queue_depths):
+        now = time.time()
+        with self._lock:
+            self.nb_batches += 1
+            for stage, name, pid, tid, start, end, nbytes in \
+                                                     meta.get('spans', []):
+                s = self._spans.setdefault(stage, {}).setdefault(name,
+                                                                 [0, 0, 0, 0])
+                s[0] += 1
+                s[1] += end-start
+                s[2] = max(s[2], end-start)
+                s[3] += nbytes
+                if self.events is not None:
+                    self._threads[(pid, tid)] = stage
+                    self.events.append(('span', name, stage, pid, tid, start,
+                                        end, nbytes, meta['seq']))
+            for name, (depth, capacity) in queue_depths.items():
+                q = self._queues.setdefault(name, [0, 0, 0, 0, capacity])
+                q[0] += 1
+                q[1] += depth
+                q[2] = max(q[2], depth)
+                q[3] = depth
+            if self.events is not None:
+                self.events.append(('depths', now, dict(
+                    [(name, d[0]) for name, d in queue_depths.items()])))
+    
+    def snapshot(self):
+        with self._lock:
+            elapsed = 0
+            if self.start_time is not None:
+                elapsed = time.time()-self.start_time
+            stages = {}
+            for stage, names in self._spans.items():
+                stages[stage] = {}
+                for name, (count, seconds, max_seconds, nbytes) in \
+                                                              names.items():
+                    stages[stage][name] = {'count': count,
+                                           'seconds': seconds,
+                                           'mean_seconds': seconds/count,
+                                           'max_seconds': max_seconds,
+                                           'bytes': nbytes}
+            queues = {}
+            for name, (n, total, max_depth, last, capacity) in \
+                                                       self._queues.items():
+                queues[name] = {'mean': total/n, 'max': max_depth,
+                                'last': last, 'capacity': capacity}
+            consumer = stages.get('consumer', {})
+            stall = consumer.get('stall', {}).get('seconds', 0)
+            busy = consumer.get('busy', {}).get('seconds', 0)
+            stall_fraction = stall/(stall+busy) if stall+busy > 0 else 0
+            return {'elapsed_seconds': elapsed,
+                    'batches': self.nb_batches,
+                    'batches_per_second': (self.nb_batches/elapsed
+                                           if elapsed > 0 else 0),
+                    'consumer_stall_fraction': stall_fraction,
+                    'stages': stages,
+                    'queues': queues}
+    
+    def trace(self):
+        # Return the trace events in the Chrome trace event format, with
+        # times in microseconds since the start.
+        with self._lock:
+            t0 = self.start_time or 0
+            events = []
+            for (pid, tid), stage in self._threads.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': tid, 'args': {'name': stage}})
+            pid = os.getpid()
+            for event in self.events:
+                if event[0]=='depths':
+                    events.append({'name': 'queue depths', 'ph': 'C',
+                                   'pid': pid, 'ts': (event[1]-t0)*1e6,
+                                   'args': event[2]})
+                    continue
+                _, name, stage, pid_, tid, start, end, nbytes, seq = event
+                events.append({'name': name, 'cat': stage, 'ph': 'X',
+                               'pid': pid_, 'tid': tid,
+                               'ts': (start-t0)*1e6,
+                               'dur': (end-start)*1e6,
+                               'args': {'bytes': nbytes, 'seq': seq}})
+            return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _nbytes(batch):
+    # The number of bytes in the arrays of a batch (nested in lists, tuples,
+    # and dicts).
+    if type(batch) in (list, tuple):
+        return sum([_nbytes(b) for b in batch])
+    if type(batch) is dict:
+        return sum([_nbytes(b) for b in batch.values()])
+    return getattr(batch, 'nbytes', 0)
+
+
+class _remote_traceback(Exception):
+    def __init__(self, tb):
+        self.tb = tb
+        
+    def __str__(self):
+        return self.tb
+    
+    
+class _stage_error(object):
+    """
+    Passed down the data_flow pipeline in place of a batch when a stage fails,
+    so that the consumer re-raises the exception. Must be created while the
+    exception is being handled.
+    """
+    def __init__(self, exc):
+        self.traceback = traceback.format_exc()
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            exc = RuntimeError(repr(exc))
+        self.exc = exc
+        
+    def reraise(self):
+        self.exc.__cause__ = _remote_traceback(self.traceback)
+        raise self.exc
+    
+    
+def _is_array_like(arr):
+    return (getattr(arr, 'shape', None) is not None
+            and getattr(arr, 'dtype', None) is not None)
+
+
+def _identity(batch):
+    return batch
+
+
+def _new_recorder(stage, metrics):
+    # Must be called in the thread or process that runs the stage.
+    if not metrics:
+        return _no_recorder()
+    return _span_recorder(stage)
+
+
+def _takes_rng(function):
+    try:
+        parameters = inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'rng' in parameters
+
+
+def _drain(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+class _shared_array(object):
+    """
+    Describes an array stored in a shared memory slot.
+    """
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+class _shared_memory_ring(object):
+    """
+    A ring of preallocated shared memory slots through which batches are
+    passed between threads or processes. The arrays in a batch (which may be
+    nested in lists, tuples, and dicts) are copied into a free slot so that
+    only the slot number and the offset, shape, and dtype of each array need
+    to pass through a queue. The receiver gets arrays that are views into the
+    slot and releases the slot once it is done with them.
+    
+    nb_slots   : the number of slots
+    slot_bytes : the size of each slot, in bytes
+    context    : the multiprocessing context of the processes that use it
+    """
+    align = 64      # Alignment of arrays in a slot, in bytes.
+    
+    def __init__(self, nb_slots, slot_bytes, context=multiprocessing):
+        from multiprocessing import shared_memory
+        self.nb_slots = nb_slots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(nb_slots*slot_bytes, 1))
+        self.free_slots = context.Queue()
+        for slot in range(nb_slots):
+            self.free_slots.put(slot)
+        self._warned = False
+        
+    def acquire(self):
+        # Block until a slot is free. Returns None if woken up by a sentinel
+        # on shutdown.
+        return self.free_slots.get()
+    
+    def release(self, slot):
+        self.free_slots.put(slot)
+        
+    def pack(self, slot, batch):
+        """
+        Copy the arrays in `batch` into `slot`. Returns the batch with every
+        array replaced by its description, or None if the batch does not fit.
+        """
+        end = (slot+1)*self.slot_bytes
+        offset = [slot*self.slot_bytes]
+        
+        def _pack(obj):
+            if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+                start = -(-offset[0]//self.align)*self.align
+                if start+obj.nbytes > end:
+                    raise MemoryError
+                arr = np.ndarray(obj.shape, dtype=obj.dtype,
+                                 buffer=self.shm.buf, offset=start)
+                arr[...] = obj
+                offset[0] = start+obj.nbytes
+                return _shared_array(start, obj.shape, obj.dtype)
+            if type(obj) in (list, tuple):
+                return type(obj)([_pack(o) for o in obj])
+            if type(obj) is dict:
+                return dict([(k, _pack(v)) for k, v in obj.items()])
+            return obj
+        
+        try:
+            return _pack(batch)
+        except MemoryError:
+            if not self._warned:
+                warnings.warn("A batch does not fit in a shared memory slot "
+                              "of {} bytes and is passed by pickling instead; "
+                              "consider increasing shm_slot_bytes."
+                              "".format(self.slot_bytes), RuntimeWarning)
+                self._warned = True
+            return None
+        
+    def unpack(self, packed_batch):
+        """
+        Return the batch described by `packed_batch`, with arrays that are
+        views into shared memory.
+        """
+        if isinstance(packed_batch, _shared_array):
+            arr = np.ndarray(packed_batch.shape, dtype=packed_batch.dtype,
+                             buffer=self.shm.buf, offset=packed_batch.offset)
+            return np.asarray(_shared_view(arr, self.shm))
+        if type(packed_batch) in (list, tuple):
+            return type(packed_batch)([self.unpack(o) for o in packed_batch])
+        if type(packed_batch) is dict:
+            return dict([(k, self.unpack(v))
+                         for k, v in packed_batch.items()])
+        return packed_batch
+    
+    def close(self):
+        # Only unlink the shared memory: unpacked arrays that are still in
+        # use keep it mapped, and it is unmapped once they (and this ring)
+        # are garbage collected.
+        self.free_slots.close()
+        self.shm.unlink()
+
+
+class _shared_view(object):
+    """
+    Exposes an array that is a view into shared memory to numpy.asarray(),
+    so that the resulting array keeps a reference to the shared memory (and
+    thus keeps it mapped) as long as it is in use.
+    """
+    def __init__(self, arr, shm):
+        self.__array_interface__ = arr.__array_interface__
+        self.arr = arr
+        self.shm = shm
+
+
+class _buffer_pool(object):
+    """
+    A pool of preallocated arrays, recycled so that batches can be read
+    without allocating memory.
+    
+    lag : the number of batches that must be put in a queue after a batch
+        before the buffers it uses are no longer read by the queue; if None,
+        buffers put in a queue are never recycled
+    """
+    def __init__(self, lag):
+        self.lag = lag
+        self._free = {}
+        self._held = deque()
+        self._nb_put = 0
+        self._lock = threading.Lock()
         
+    def __getstate__(self):
+        # A pool that is pickled (eg. to be sent to a loader process) is
+        # unpickled empty.
+        return {'lag': self.lag}
+    
+    def __setstate__(self, state):
+        self.__init__(state['lag'])
         
+    def get(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            if self._free.get(key):
+                return self._free[key].pop()
+        return np.empty(shape, dtype=dtype)
+    
+    def release(self, buffers):
+        with self._lock:
+            self._release(buffers)
+            
+    def release_after_puts(self, buffers):
+        """
+        Call after putting a batch that uses `buffers` in a queue; they are
+        released once `lag` more batches have been put in the queue.
+        """
+        if self.lag is None:
+            return
+        with self._lock:
+            self._nb_put += 1
+            self._held.append((self._nb_put, buffers))
+            while self._held and self._held[0][0]+self.lag <= self._nb_put:
+                self._release(self._held.popleft()[1])
+                
+    def _release(self, buffers):
+        for buf in buffers:
+            key = (buf.shape, buf.dtype)
+            self._free.setdefault(key, []).append(buf)
+
+
+def _prepare_batch(batch, ring):
+    """
+    Prepare a batch to be put in a queue: if a shared memory ring is used,
+    copy the batch into a free slot and return (slot, packed batch), or
+    (None, batch) if it does not fit. Returns None if woken up on shutdown
+    while waiting for a free slot.
+    """
+    if ring is None:
+        return batch
+    slot = ring.acquire()
+    if slot is None:
+        return None
+    packed_batch = ring.pack(slot, batch)
+    if packed_batch is None:
+        ring.release(slot)
+        return (None, batch)
+    return (slot, packed_batch)
+
+
+def _receive_batch(item, ring):
+    """
+    Return (batch, slot) for an item taken from a queue, where slot is the
+    shared memory slot holding the batch, which must be released once the
+    batch is no longer needed (None if no slot is used).
+    """
+    if ring is None:
+        return item, None
+    slot, packed_batch = item
+    if slot is None:
+        return packed_batch, None
+    return ring.unpack(packed_batch), slot
+
+
+class sum_tree(object):
+    """
+    A binary tree over a list of non-negative weights in which every node
+    holds the sum of the weights below it. Drawing indices with probability
+    proportional to their weights and updating weights both take O(log N)
+    time per index, and are vectorized over batches of indices. All methods
+    are threadsafe.
+    
+    weights : the initial weights
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim!=1 or len(weights)==0:
+            raise ValueError("Weights must be a non-empty list.")
+        _check_weights(weights)
+        if not np.any(weights>0):
+            raise ValueError("Weights must not all be zero.")
+        self.length = len(weights)
+        self.capacity = 1
+        while self.capacity < self.length:
+            self.capacity *= 2
+        self.depth = int(np.log2(self.capacity))
+        
+        # The root is at 1; the children of node i are at 2i and 2i+1; the
+        # leaves are at [capacity, 2*capacity).
+        self._tree = np.zeros(2*self.capacity, dtype=np.float64)
+        self._tree[self.capacity:self.capacity+self.length] = weights
+        level = self.capacity//2
+        while level >= 1:
+            children = self._tree[2*level:4*level]
+            self._tree[level:2*level] = children[0::2]+children[1::2]
+            level //= 2
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return self.length
+    
+    @property
+    def total(self):
+        return self._tree[1]
+    
+    def get_weights(self, indices=None):
+        with self._lock:
+            leaves = self._tree[self.capacity:self.capacity+self.length]
+            if indices is None:
+                return leaves.copy()
+            return leaves[indices]
+        
+    def update(self, indices, values):
+        """
+        Set the weights at `indices` to `values`.
+        """
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.int64))
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64),
+                                 indices.shape)
+        _check_weights(values)
+        if np.any(indices<0) or np.any(indices>=self.length):
+            raise IndexError("Weight index out of range.")
+        if len(indices)==0:
+            return
+        with self._lock:
+            nodes = indices+self.capacity
+            previous_values = self._tree[nodes]
+            self._set_leaves(nodes, values)
+            if self._tree[1] <= 0:
+                self._set_leaves(nodes[::-1], previous_values[::-1])
+                raise ValueError("Weights must not all be zero.")
+                
+    def _set_leaves(self, nodes, values):
+        self._tree[nodes] = values
+        # Recompute the sums of all ancestors, level by level.
+        for level in range(self.depth):
+            nodes = np.unique(nodes//2)
+            self._tree[nodes] = self._tree[2*nodes]+self._tree[2*nodes+1]
+            
+    def sample(self, size, rng):
+        """
+        Draw `size` indices with replacement, with probability proportional
+        to their weights, using the numpy RandomState `rng`.
+        """
+        with self._lock:
+            u = rng.random_sample(size)*self._tree[1]
+            nodes = np.ones(size, dtype=np.int64)
+            for level in range(self.depth):
+                left = self._tree[2*nodes]
+                # Never descend into a subtree of zero weight, which
+                # rounding errors could otherwise allow.
+                go_right = (u >= left) & (self._tree[2*nodes+1] > 0)
+                u -= left*go_right
+                nodes = 2*nodes+go_right
+        return nodes-self.capacity
+
+
+def _check_weights(weights):
+    if not np.all(np.isfinite(weights)) or np.any(weights<0):
+        raise ValueError("Weights must be finite and non-negative.")
+    
+
+def shard_length(array_length, world_size, pad=True):
+    """
+    The number of indices that each of `world_size` ranks samples from an
+    epoch of `array_length` indices (see index_sampler).
+    """
+    if pad:
+        return -(-array_length//world_size)
+    return array_length//world_size
+
+
 class index_sampler(object):
     """
     An iterable that generates array indices according to some sampling
-    strategy.
+    strategy. Indices for an epoch (array_length indices) are generated as
+    numpy arrays, all at once or, when sampling with replacement or in order,
+    in blocks of bounded length; iterate over batches of indices with
+    iter_batches() rather than over single indices for speed.
     
     array_length : the length of the array to sample from - indicies are
         generated in the range [0, array_length-1].
-    random : sample in random order if True.
+    random : sample in random order if True. If 'block', sample blocks of
+        `block_size` consecutive indices in random order and shuffle the
+        indices within a sliding window of `block_window` blocks.
     replacement : when doing random sampling, sample with replacement if True;
         when this is active, the iterator never stops iterating since it never
         runs out of elements to sample.
     weights : a list of relative importance weights for every index; when 
         normalized, these determine the probability for each element of being
-        sampled.
+        sampled. Without replacement, elements are drawn one after the other
+        with probabilities proportional to the weights of the elements not
+        yet drawn; elements with zero weight come last. May be a sum_tree,
+        whose weights can be updated during sampling: with replacement,
+        each batch from iter_batches() is drawn with the weights at the time
+        it is requested; without replacement, the weights at the start of
+        the epoch are used.
     rng : random number generator
+    block_size : the number of consecutive indices in a block when random is
+        'block'; if None, 1.
+    block_window : the number of blocks over which indices are shuffled
+        together when random is 'block'.
+    rank : the rank of this sampler among `world_size` samplers that share
+        the epoch; each gets a disjoint, contiguous share of the indices of
+        the epoch (when sampling with replacement, each draws its share
+        independently).
+    world_size : the number of samplers that share the epoch.
+    pad : if True, every rank gets ceil(array_length/world_size) indices,
+        padding the epoch with indices from its start; if False, every rank
+        gets floor(array_length/world_size) indices, dropping the rest.
+    seed : if not None, an integer from which to seed the rng, along with
+        `epoch` (and `rank`, when sampling with replacement), so that all
+        ranks sample the same epoch. Required to shard random sampling
+        without replacement.
+    epoch : the epoch number, with which the rng is seeded if `seed` is set.
     """
+    # The maximum number of indices generated at once when sampling with
+    # replacement or in order.
+    max_block_length = 2**20
+    
     def __init__(self, array_length, random=True, replacement=False,
-                 weights=None, rng=None):
+                 weights=None, rng=None, block_size=None, block_window=4,
+                 rank=0, world_size=1, pad=True, seed=None, epoch=0):
         self.array_length = array_length
         self.random = random
         self.replacement = replacement
         self.weights = weights
+        self.rank = rank
+        self.world_size = world_size
+        self.pad = pad
+        self.seed = seed
+        self.epoch = epoch
+        if not 0 <= rank < world_size:
+            raise ValueError("The rank must be in [0, world_size).")
+        if (world_size > 1 and random and not replacement
+                and seed is None):
+            raise ValueError("A seed shared by all ranks is required to "
+                             "shard random sampling without replacement.")
+        self.length = shard_length(array_length, world_size, pad)
+        if seed is not None:
+            if random and replacement:
+                rng = np.random.RandomState([seed, epoch, rank])
+            else:
+                rng = np.random.RandomState([seed, epoch])
         if rng is None:
             self.rng = np.random.RandomState()
         else:
             self.rng = rng
+        self.block_size = block_size if block_size is not None else 1
+        self.block_window = block_window
+        if random=='block' and (replacement or weights is not None):
+            raise ValueError("Block sampling cannot be combined with "
+                             "sampling with replacement or sample weights.")
+        if weights is not None and len(weights)!=array_length:
+            raise ValueError("There must be one weight per index.")
+        if weights is not None and not isinstance(weights, sum_tree):
+            weights = np.asarray(weights, dtype=np.float64)
+            if np.any(weights<0) or not np.any(weights>0):
+                raise ValueError("Weights must be non-negative and not all "
+                                 "zero.")
+        
+    def __len__(self):
+        return self.length
         
     def __iter__(self):
-        for idx in self._gen_idx():
-            yield idx
+        for block in self._gen_blocks():
+            for idx in block:
+                yield idx
+                
+    def iter_batches(self, batch_size):
+        """
+        Iterate over the indices of an epoch (this rank's share of them) in
+        batches of `batch_size`, yielding an int64 array per batch. The last
+        batch may be smaller.
+        """
+        if (self.random and self.replacement
+                and isinstance(self.weights, sum_tree)):
+            # Draw each batch only when it is requested so that any weight
+            # updates apply to it.
+            n = self.length
+            for start in range(0, n, batch_size):
+                yield self.weights.sample(min(batch_size, n-start), self.rng)
+            return
+        remainder = []
+        remainder_length = 0
+        for block in self._gen_blocks():
+            # Complete a batch started in the previous block.
+            start = 0
+            if remainder_length:
+                start = min(batch_size-remainder_length, len(block))
+                remainder.append(block[:start])
+                remainder_length += start
+                if remainder_length < batch_size:
+                    continue
+                yield np.concatenate(remainder)
+                remainder = []
+                remainder_length = 0
+            # Slice whole batches out of the block.
+            stop = start+(len(block)-start)//batch_size*batch_size
+            for i in range(start, stop, batch_size):
+                yield block[i:i+batch_size]
+            if stop < len(block):
+                remainder = [block[stop:]]
+                remainder_length = len(block)-stop
+        if remainder_length:
+            yield np.concatenate(remainder)
             
-    def _gen_idx(self):   
-        if self.random:
-            normalized_weights = None
+    def _gen_blocks(self):
+        if self.world_size==1 or (self.random and self.replacement):
+            # Draws with replacement are independent, so each rank draws
+            # only its share.
+            for block in self._gen_epoch_blocks():
+                yield block
+            return
+        # Take this rank's contiguous share of the indices of the epoch,
+        # which are the same for all ranks. Positions past the end of the
+        # epoch wrap around to its start.
+        n = self.array_length
+        start = self.rank*self.length
+        stop = start+self.length
+        nb_head = min(max(stop-n, 0), n)
+        head = []
+        offset = 0
+        for block in self._gen_epoch_blocks():
+            if offset < nb_head:
+                head.append(block[:nb_head-offset])
+            lo = max(start-offset, 0)
+            hi = min(stop-offset, len(block))
+            if lo < hi:
+                yield block[lo:hi]
+            offset += len(block)
+            if offset >= stop:
+                break
+        if nb_head:
+            head = np.concatenate(head)
+            yield head[np.arange(max(start, n), stop)%n]
+            
+    def _gen_epoch_blocks(self):
+        n = self.array_length
+        max_block_length = self.max_block_length
+        if self.random=='block':
+            indices = np.arange(n, dtype=np.int64)
+            order = _block_shuffle(indices//self.block_size,
+                                   self.block_window, self.rng)
+            yield indices[order]
+        elif (self.random and self.replacement
+                  and isinstance(self.weights, sum_tree)):
+            for start in range(0, self.length, max_block_length):
+                length = min(max_block_length, self.length-start)
+                yield self.weights.sample(length, self.rng)
+        elif self.random and self.replacement:
+            cdf = None
             if self.weights is not None:
-                normalized_weights = np.array(self.weights) \
-                                     / float(np.sum(self.weights))
-            indices = self.rng.choice(range(self.array_length),
-                                      size=self.array_length,
-                                      replace=self.replacement,
-                                      p=normalized_weights)
+                cdf = np.cumsum(np.asarray(self.weights, dtype=np.float64))
+                cdf /= cdf[-1]
+            for start in range(0, self.length, max_block_length):
+                length = min(max_block_length, self.length-start)
+                if cdf is None:
+                    block = self.rng.randint(0, n, size=length)
+                    yield block.astype(np.int64, copy=False)
+                else:
+                    # Inverse transform sampling. Searching for the samples
+                    # in sorted order makes the search much faster.
+                    u = self.rng.random_sample(length)
+                    order = np.argsort(u)
+                    block = np.empty(length, dtype=np.int64)
+                    block[order] = np.searchsorted(cdf, u[order], side='right')
+                    yield block
+        elif self.random:
+            if self.weights is None:
+                indices = self.rng.permutation(n)
+                yield indices.astype(np.int64, copy=False)
+            else:
+                # Weighted sampling without replacement, as an exponential
+                # race: each element draws an exponential arrival time with
+                # rate equal to its weight and elements are taken in order of
+                # arrival.
+                if isinstance(self.weights, sum_tree):
+                    weights = self.weights.get_weights()
+                else:
+                    weights = np.asarray(self.weights, dtype=np.float64)
+                with np.errstate(divide='ignore'):
+                    keys = self.rng.exponential(size=n)/weights
+                indices = np.argsort(keys, kind='stable')
+                yield indices.astype(np.int64, copy=False)
         else:
-            indices = list(range(self.array_length))
-        for idx in indices:
-            yield idx
+            for start in range(0, n, max_block_length):
+                yield np.arange(start, min(start+max_block_length, n),
+                                dtype=np.int64)
+
+
+class memory_sample_cache(_lru_cache):
+    """
+    A thread-safe, in-memory cache of the outputs of the cache_fn of a
+    data_flow, by sample index, that evicts the least recently used samples
+    once the total size of the cached outputs exceeds a byte budget. Cached
+    arrays are shared, not copied, every time the sample is used, so they are
+    made read-only. Statistics are kept as detailed in wrap._lru_cache; a
+    pickled cache is unpickled empty, so it cannot be shared with loader
+    processes (use a disk_sample_cache instead).
+    
+    max_bytes : the byte budget; outputs larger than this are never cached
+    """
+    _count_name = 'num_samples'
+    
+    def __init__(self, max_bytes):
+        super(memory_sample_cache, self).__init__(max_bytes)
+        self.version = None
+        
+    def open(self, version, length, compute):
+        """
+        Prepare the cache to hold the outputs of the cache_fn identified by
+        `version` for `length` samples, clearing it if it holds the outputs
+        of another version. `compute(i)` returns the outputs for sample i.
+        """
+        if version!=self.version:
+            self.clear()
+            self.version = version
+            
+    def put(self, index, outputs):
+        """
+        Cache the outputs for the sample at `index`.
+        """
+        nbytes = _nbytes(outputs)
+        if nbytes > self.max_bytes:
+            return
+        for output in outputs:
+            if isinstance(output, np.ndarray):
+                output.flags.writeable = False  # Cached outputs are shared.
+        self._put(index, outputs, nbytes)
+        
+    def __getstate__(self):
+        state = super(memory_sample_cache, self).__getstate__()
+        state['version'] = self.version
+        return state
+    
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+        self.version = state['version']
+    
+    
+class disk_sample_cache(object):
+    """
+    A cache of the outputs of the cache_fn of a data_flow, by sample index,
+    kept on disk in memory mapped .npy files in a local directory: one file
+    for each output, holding that output for every sample, along with a flag
+    per sample that is set once its outputs are written. Every output of
+    cache_fn must thus be an array (or scalar) of the same shape and dtype for
+    all samples. The files are created when a data_flow first uses the cache,
+    from the outputs for the first sample.
+    
+    The cache is shared by all the loaders of a data_flow, including loader
+    processes, and is kept across runs: it is only cleared when it is opened
+    with a different version (see the cache_version of data_flow) or number
+    of samples. Several data_flows may read and write the same directory at
+    once, but only once it has been created. The `hits` and `misses`
+    counters, also returned by get_stats(), only count the accesses in this
+    process.
+    
+    path : the directory in which to keep the cache (created if needed)
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._arrays = None
+        self._lock = threading.Lock()
+        
+    def open(self, version, length, compute):
+        """
+        Prepare the cache to hold the outputs of the cache_fn identified by
+        `version` for `length` samples, creating it anew if it holds the
+        outputs of another version or another number of samples. `compute(i)`
+        returns the outputs for sample i.
+        """
+        meta_path = os.path.join(self.path, 'meta.json')
+        version = json.loads(json.dumps(version))
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        if (meta is not None and meta['version']==version
+                             and meta['length']==length):
+            return
+        
+        # Create the files, then write the metadata, which marks the cache as
+        # valid.
+        with self._lock:
+            self._arrays = None
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        outputs = [np.asarray(output) for output in compute(0)]
+        for k, output in enumerate(outputs):
+            if output.dtype.hasobject:
+                raise ValueError("The outputs of cache_fn must be numeric "
+                                 "arrays to be cached on disk.")
+            np.lib.format.open_memmap(self._get_file(k), mode='w+',
+                                      dtype=output.dtype,
+                                      shape=(length,)+output.shape)
+        np.lib.format.open_memmap(self._get_file('valid'), mode='w+',
+                                  dtype=np.uint8, shape=(length,))
+        meta = {'version': version,
+                'length': length,
+                'num_outputs': len(outputs)}
+        with open(meta_path+'.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path+'.tmp', meta_path)
+        self.put(0, outputs)
+        
+    def _get_file(self, name):
+        return os.path.join(self.path, '{}.npy'.format(name))
+    
+    def _get_arrays(self):
+        # Return the memory maps of the valid flags and the outputs, opening
+        # the files if they are not yet open in this process.
+        with self._lock:
+            if self._arrays is None:
+                with open(os.path.join(self.path, 'meta.json')) as f:
+                    meta = json.load(f)
+                names = ['valid']+list(range(meta['num_outputs']))
+                self._arrays = [np.load(self._get_file(name), mmap_mode='r+')
+                                for name in names]
+            return self._arrays
+        
+    def get(self, index):
+        """
+        Return (copies of) the cached outputs for the sample at `index`, or
+        None.
+        """
+        arrays = self._get_arrays()
+        if not arrays[0][index]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tuple([np.array(arr[index]) for arr in arrays[1:]])
+    
+    def put(self, index, outputs):
+        """
+        Cache the outputs for the sample at `index`.
+        """
+        arrays = self._get_arrays()
+        if len(outputs)!=len(arrays)-1:
+            raise ValueError("cache_fn returned {} outputs; {} were cached "
+                             "before.".format(len(outputs), len(arrays)-1))
+        for arr, output in zip(arrays[1:], outputs):
+            if np.shape(output)!=arr.shape[1:]:
+                raise ValueError("cache_fn returned an output of shape {}; "
+                                 "the cached outputs have shape {}."
+                                 "".format(np.shape(output), arr.shape[1:]))
+            arr[index] = output
+        # Flag the sample once its outputs are written.
+        arrays[0][index] = 1
+        
+    def clear(self):
+        arrays = self._get_arrays()
+        arrays[0][:] = 0
+        
+    def get_stats(self):
+        arrays = self._get_arrays()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'num_samples': int(np.count_nonzero(arrays[0]))}
+    
+    def __getstate__(self):
+        # The memory maps are opened anew in every process.
+        return {'path': self.path}
+    
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+        
+    def __len__(self):
+        return int(np.count_nonzero(self._get_arrays()[0]))
 
 
 class buffered_array_writer(object):
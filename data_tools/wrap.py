@@ -1,7 +1,548 @@
+import copy
+import itertools
+import os
+import struct
+import threading
 import warnings
+import zipfile
+from collections import (OrderedDict,
+                         deque)
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 
+def _is_simple_key(key_remainder):
+    """
+    Return True if the key for the non-first dimensions contains no index
+    lists or arrays (only integers, slices, and ellipsis) so that it can be
+    applied to a block of elements at once.
+    """
+    if key_remainder is None:
+        return True
+    for k in key_remainder:
+        if hasattr(k, '__len__'):
+            return False
+    return True
+
+
+def _split_key(key, ndim):
+    """
+    Split a numpy-style index `key` for an array with `ndim` dimensions into
+    the key for the first dimension and a tuple of keys for the remaining
+    dimensions (None if there are none).
+    
+    Boolean arrays are converted to integer index arrays (one per dimension
+    that they cover) and all index lists in a tuple key are converted to 1D
+    integer arrays, broadcast against each other, so that they index in
+    tandem.
+    """
+    if isinstance(key, np.ndarray):
+        if key.dtype==np.bool_:
+            key = key.nonzero()
+        elif key.ndim==0:
+            key = key.item()
+        elif key.ndim > 1:
+            raise IndexError("indexing by non-boolean multidimensional "
+                             "arrays not supported")
+    elif isinstance(key, list):
+        # As with numpy, a list that contains sequences is a tuple of keys, one
+        # per dimension; otherwise, it indexes only the first dimension.
+        for k in key:
+            if hasattr(k, '__len__'):
+                key = tuple(key)
+                break
+    if not isinstance(key, tuple):
+        return key, None
+    
+    # Convert index lists to arrays, expanding boolean arrays.
+    key_list = []
+    for k in key:
+        if hasattr(k, '__len__'):
+            k = np.asarray(k)
+            if k.dtype==np.bool_:
+                key_list.extend(k.nonzero())
+                continue
+            if k.size==0:
+                k = k.astype(np.int64)
+            if k.ndim > 1:
+                raise IndexError("indexing by non-boolean multidimensional "
+                                 "arrays not supported")
+        key_list.append(k)
+    n_indices = len([k for k in key_list if k is not Ellipsis])
+    if n_indices > ndim:
+        raise IndexError("too many indices for array")
+    
+    # Broadcast index arrays against each other.
+    arrays = [k for k in key_list if isinstance(k, np.ndarray)]
+    if arrays:
+        try:
+            shape = np.broadcast_shapes(*[k.shape for k in arrays])
+        except ValueError:
+            raise IndexError("shape mismatch: indexing arrays could not be "
+                             "broadcast together with shapes "
+                             ""+" ".join([str(k.shape) for k in arrays]))
+        key_list = [np.broadcast_to(k, shape) if isinstance(k, np.ndarray)
+                    else k for k in key_list]
+    if len(key_list)==0:
+        return slice(None), None
+    return key_list[0], tuple(key_list[1:])
+
+
+def _gather(arr, indices, key_remainder=None, out=None):
+    """
+    Read the elements at the first dimension `indices` of `arr` using as few
+    reads as possible. The unique indices are sorted and merged into
+    contiguous runs; each run is read from `arr` with a single slice read and
+    the elements are then put back in the requested order (including any
+    repeated indices).
+    
+    Numpy arrays (and memory maps) are instead indexed directly, with a single
+    call.
+    
+    arr           : the source array (must support slicing)
+    indices       : integer indices into the first dimension of arr
+    key_remainder : (optional) a key for the remaining dimensions; any index
+        arrays in it must have the same length as `indices` and index in
+        tandem with it
+    out           : (optional) an array of the right shape and dtype into
+        which to read the elements; it is returned
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if key_remainder is None:
+        key_remainder = ()
+    if isinstance(arr, np.ndarray):
+        if out is None:
+            return arr[(indices,)+key_remainder]
+        if key_remainder==() and out.dtype==arr.dtype:
+            return np.take(arr, indices, axis=0, out=out)
+        out[...] = arr[(indices,)+key_remainder]
+        return out
+    if not _is_simple_key(key_remainder):
+        # Read whole elements, then apply the index arrays in memory.
+        elements = _gather(arr, indices)
+        elements = elements[(np.arange(len(indices)),)+key_remainder]
+        if out is None:
+            return elements
+        out[...] = elements
+        return out
+    if len(indices)==0:
+        if out is None:
+            return np.asarray(arr[(slice(0, 0),)+key_remainder])
+        return out
+    
+    # Merge the sorted, unique indices into runs of consecutive indices.
+    unique, inverse = np.unique(indices, return_inverse=True)
+    breaks = np.flatnonzero(np.diff(unique)!=1)+1
+    run_starts = np.concatenate([[0], breaks])
+    run_stops = np.concatenate([breaks, [len(unique)]])
+    in_order = (len(unique)==len(indices)
+                and np.array_equal(unique, indices))
+    
+    # Make a single read per run. If the requested order is the sorted
+    # order, read straight into `out`.
+    runs = []
+    for a, b in zip(run_starts, run_stops):
+        run_key = slice(int(unique[a]), int(unique[b-1])+1)
+        run = np.asarray(arr[(run_key,)+key_remainder])
+        if out is not None and in_order:
+            out[a:b] = run
+        else:
+            runs.append(run)
+    if out is not None and in_order:
+        return out
+    if len(runs)==1:
+        block = runs[0]
+    else:
+        block = np.concatenate(runs)
+    
+    # Restore the requested order.
+    if in_order:
+        return block
+    if out is None:
+        return block[inverse.ravel()]
+    return np.take(block, inverse.ravel(), axis=0, out=out)
+
+
+def _memmap_npz_member(path, name):
+    """
+    Open the array `name` in the uncompressed .npz file at `path` as a
+    read-only memory map (numpy.load does not memory map .npz members).
+    """
+    with zipfile.ZipFile(path) as npz:
+        info = npz.getinfo(name+'.npy')
+    if info.compress_type!=zipfile.ZIP_STORED:
+        raise ValueError("Cannot memory map {} in {}: the file is "
+                         "compressed.".format(name, path))
+    with open(path, 'rb') as f:
+        # Skip the zip local file header to find the start of the .npy data.
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset+30+name_len+extra_len)
+        version = np.lib.format.read_magic(f)
+        if version==(1, 0):
+            read_header = np.lib.format.read_array_header_1_0
+        elif version==(2, 0):
+            read_header = np.lib.format.read_array_header_2_0
+        else:
+            raise ValueError("Cannot memory map {} in {}: unsupported .npy "
+                             "format version {}".format(name, path, version))
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if int(np.prod(shape))==0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _get_chunk_length(arr):
+    """
+    Return the number of elements along the first dimension in each storage
+    chunk of `arr` (eg. an h5py or zarr dataset), or None if arr is not
+    chunked. For a delayed_view or multi_source_array, this is its (largest)
+    block size, which is taken from the chunks of its sources.
+    """
+    if isinstance(arr, multi_source_array):
+        block_size = int(np.max(arr.block_sizes, initial=1))
+        return block_size if block_size > 1 else None
+    if isinstance(arr, delayed_view):
+        return arr.block_size if arr.block_size > 1 else None
+    chunks = getattr(arr, 'chunks', None)
+    if not chunks:
+        return None
+    return int(chunks[0])
+
+
+def _group_positions(keys):
+    """
+    Group the positions in `keys` by value. Returns a list with, for each
+    unique value in keys (in increasing order), the array of positions at
+    which that value occurs (in increasing order).
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    bounds = np.flatnonzero(np.diff(keys[order]))+1
+    return [group for group in np.split(order, bounds) if len(group)]
+
+
+def _block_shuffle(block_ids, window, rng):
+    """
+    Return a permutation that shuffles elements in a way that keeps elements
+    of the same block close together. The blocks are put in random order and
+    then each element is moved to a random position within a sliding window of
+    `window` blocks about its block's position, so that the elements of
+    neighbouring blocks are also shuffled together.
+    
+    block_ids : the block number of each element
+    window    : the size of the sliding window, in blocks
+    rng       : numpy random number generator
+    """
+    block_ids = np.asarray(block_ids)
+    unique, inverse = np.unique(block_ids, return_inverse=True)
+    block_rank = rng.permutation(len(unique))[inverse.ravel()]
+    keys = block_rank+rng.uniform(0, window, size=len(block_ids))
+    return np.argsort(keys, kind='stable')
+
+
+class _lru_cache(object):
+    """
+    A thread-safe cache that evicts the least recently used items once their
+    total size exceeds a byte budget. A cache that is pickled (eg. to be sent
+    to another process) is unpickled empty.
+    
+    Cache statistics are recorded in the `hits`, `misses`, and `evictions`
+    counters and the current size of the cache, in bytes, is `nbytes`. These
+    are also returned as a dictionary by get_stats(), along with the number of
+    cached items (under the name `_count_name`).
+    
+    max_bytes : the byte budget; items larger than this are never cached
+    """
+    _count_name = 'num_items'
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()     # {key: (item, nbytes)}
+        self._lock = threading.Lock()
+        
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        
+    def _put(self, key, item, nbytes):
+        with self._lock:
+            if key in self._items:
+                # Another thread already loaded this item.
+                return
+            self._items[key] = (item, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+    
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+                
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+            
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'nbytes': self.nbytes,
+                    self._count_name: len(self._items)}
+        
+    def __len__(self):
+        return len(self._items)
+
+
+class chunk_cache(_lru_cache):
+    """
+    A thread-safe cache of decompressed chunks that evicts the least recently
+    used chunks once the total size of the cached chunks exceeds a byte
+    budget. One cache can be shared by any number of cached_array objects;
+    chunks are keyed by (source, chunk index). Statistics are kept as
+    detailed in _lru_cache.
+    
+    max_bytes : the byte budget; chunks larger than this are never cached
+    """
+    _count_name = 'num_chunks'
+    
+    def put(self, key, chunk):
+        if chunk.nbytes > self.max_bytes:
+            return
+        chunk.flags.writeable = False   # Cached chunks are shared.
+        self._put(key, chunk, chunk.nbytes)
+    
+
+# Unique keys identifying each cached_array within a chunk_cache.
+_cached_array_keys = itertools.count()
+
+
+class cached_array(object):
+    """
+    Wrap an array (eg. an h5py or zarr dataset) so that all reads pass through
+    a chunk_cache. Data is read from the array one chunk (along the first
+    dimension) at a time and the decompressed chunks are kept in the cache, so
+    that repeated reads from the same chunk decompress it only once.
+    
+    Indexing the first dimension can be done with an integer, a slice, or an
+    index list; the remaining dimensions can be indexed in any way supported by
+    numpy. Returned data is always a copy.
+    
+    arr       : the source array
+    cache     : the chunk_cache to keep chunks in
+    chunk_len : the number of elements in each chunk; if None, it is taken from
+        the chunk shape of arr, if available, else it is 1
+    """
+    
+    def __init__(self, arr, cache, chunk_len=None):
+        self.arr = arr
+        self.cache = cache
+        if chunk_len is None:
+            chunk_len = _get_chunk_length(arr) or 1
+        self.chunk_len = chunk_len
+        self.dtype = arr.dtype
+        self.shape = tuple(arr.shape)
+        self.ndim = len(self.shape)
+        self.chunks = (chunk_len,)+self.shape[1:]
+        self._key = next(_cached_array_keys)
+        
+    def _get_chunk(self, chunk_idx):
+        key = (self._key, chunk_idx)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            start = chunk_idx*self.chunk_len
+            chunk = np.asarray(self.arr[start:start+self.chunk_len])
+            self.cache.put(key, chunk)
+        return chunk
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key_remainder = key[1:]
+        key = key[0]
+        
+        # Single element.
+        if isinstance(key, (int, np.integer)):
+            idx = int(key)
+            if idx < 0:
+                idx += len(self)
+            if idx < 0 or idx >= len(self):
+                raise IndexError("index {} is out of bounds for size {}"
+                                 "".format(key, len(self)))
+            chunk = self._get_chunk(idx//self.chunk_len)
+            return chunk[(idx%self.chunk_len,)+key_remainder].copy()
+        
+        # Multiple elements: read them chunk by chunk.
+        if isinstance(key, slice):
+            indices = np.arange(*key.indices(len(self)))
+        else:
+            indices = np.asarray(key)
+            if indices.dtype==np.bool_:
+                indices = indices.nonzero()[0]
+            indices = indices.astype(np.int64).ravel()
+            indices[indices < 0] += len(self)
+        block = np.empty((len(indices),)+self.shape[1:], dtype=self.dtype)
+        chunk_ids = indices//self.chunk_len
+        for group in _group_positions(chunk_ids):
+            chunk_idx = int(chunk_ids[group[0]])
+            chunk = self._get_chunk(chunk_idx)
+            block[group] = chunk[indices[group]-chunk_idx*self.chunk_len]
+        return block[(slice(None),)+key_remainder]
+    
+    def reopen(self, cache=None):
+        """
+        Return a copy of this cached_array that reads from the source array
+        reopened (see file_source.reopen()) through `cache` or, if None, through
+        a new, empty chunk_cache with the same byte budget.
+        """
+        if cache is None:
+            cache = chunk_cache(self.cache.max_bytes)
+        return cached_array(_reopen(self.arr), cache, chunk_len=self.chunk_len)
+    
+    def __len__(self):
+        return self.shape[0]
+
+
+class file_source(object):
+    """
+    A picklable reference to an array stored in a file -- an h5py dataset, a
+    zarr array, or a numpy array in a .npy or uncompressed .npz file (memory
+    mapped) -- that can be indexed like the array. The file is opened when the
+    array is first accessed. The open file is neither pickled nor copied by
+    reopen(), so that every process that reads the array (eg. a data_flow
+    loader process) opens the file itself instead of using a handle inherited
+    from another process, and reads in parallel with the other processes.
+    
+    path    : the path to the file (or zarr store)
+    name    : the name of the array within the file; required for h5py and
+        .npz files and for zarr groups
+    backend : 'h5py', 'zarr', 'npy', or 'npz'; if None, it is guessed from the
+        extension of path
+    kwargs  : (optional) a dictionary of arguments to pass on opening the
+        file (to h5py.File or zarr.open)
+    """
+    
+    _backends = {'.h5': 'h5py', '.hdf5': 'h5py', '.hdf': 'h5py',
+                 '.zarr': 'zarr', '.npy': 'npy', '.npz': 'npz'}
+    
+    def __init__(self, path, name=None, backend=None, kwargs=None):
+        if backend is None:
+            extension = os.path.splitext(path.rstrip('/'))[1].lower()
+            backend = self._backends.get(extension, None)
+            if backend is None:
+                raise ValueError("Cannot guess the backend from the "
+                                 "extension of {}; set backend.".format(path))
+        if backend not in ('h5py', 'zarr', 'npy', 'npz'):
+            raise ValueError("backend must be 'h5py', 'zarr', 'npy', or "
+                             "'npz'.")
+        if name is None and backend in ('h5py', 'npz'):
+            raise ValueError("The name of the array in {} is required."
+                             "".format(path))
+        self.path = path
+        self.name = name
+        self.backend = backend
+        self.kwargs = kwargs
+        self._file = None
+        self._arr = None
+        self._lock = threading.Lock()
+        arr = self.get_array()
+        self.dtype = arr.dtype
+        self.shape = tuple(arr.shape)
+        self.ndim = len(self.shape)
+        self.chunks = getattr(arr, 'chunks', None)
+        
+    def get_array(self):
+        """
+        Return the array, opening the file if it is not yet open.
+        """
+        with self._lock:
+            if self._arr is None:
+                self._file, self._arr = self._open()
+            return self._arr
+        
+    def _open(self):
+        # Return the open file (if it must be closed) and the array.
+        kwargs = self.kwargs or {}
+        if self.backend=='h5py':
+            import h5py
+            f = h5py.File(self.path, 'r', **kwargs)
+            return f, f[self.name]
+        if self.backend=='zarr':
+            import zarr
+            arr = zarr.open(self.path, mode='r', **kwargs)
+            if self.name is not None:
+                arr = arr[self.name]
+            return None, arr
+        if self.backend=='npy':
+            return None, np.load(self.path, mmap_mode='r')
+        return None, _memmap_npz_member(self.path, self.name)
+    
+    def reopen(self):
+        """
+        Return a copy of this file_source that opens the file anew when the
+        array is first accessed.
+        """
+        # Copying goes through __getstate__, which drops the open file.
+        return copy.copy(self)
+    
+    def close(self):
+        """
+        Close the file, if it is open; it is opened again on the next access.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            self._arr = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_arr'] = None
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def __getitem__(self, key):
+        return self.get_array()[key]
+    
+    def __len__(self):
+        return self.shape[0]
+
+
+def _reopen(source):
+    """
+    Return `source` reopened, if it supports it (see file_source.reopen()),
+    else `source` itself.
+    """
+    reopen = getattr(source, 'reopen', None)
+    if reopen is None:
+        return source
+    return reopen()
+
+
 class delayed_view(object):
     """
     Given an array, create a view into that array without preloading the viewed
@@ -21,15 +562,46 @@ class delayed_view(object):
     indexed as A[[0,1]] and A[[[0,1]]] (these are equivalent) but not as
     A[[[[0,1]]]] for which numpy would add a dimension to the output.
     
+    A delayed_view of another delayed_view (other than a multi_source_array)
+    reads directly from the underlying array, through a copy of the index map
+    of the other view taken when this view is created. Later changes to the
+    other view's order (eg. by its re_shuffle()) do not affect this view;
+    create this view anew to follow them.
+    
     arr     : the source array
-    shuffle : randomize data access order within the view
+    shuffle : randomize data access order within the view; if 'block', shuffle
+        blocks of `block_size` consecutive elements and then shuffle elements
+        within a sliding window of `block_window` blocks, so that data is read
+        in near-random order while each block is accessed within a short span
     idx_min : the view into arr starts at this index
     idx_max : the view into arr ends before this index
     rng     : numpy random number generator
+    cache   : (optional) a chunk_cache through which to read arr
+    block_size   : the number of elements in a block for block shuffling; if
+        None, it is taken from the chunk shape of arr, if available, else 1
+    block_window : the number of blocks over which elements are shuffled
+        together when block shuffling
+    readahead : when iterating, the number of blocks of upcoming elements to
+        read ahead in background threads (each block is `block_size` elements,
+        aligned to the chunks of arr when the view is in order); if 0, no
+        data is read ahead
+    readahead_workers : the number of threads that read ahead
     """
     
     def __init__(self, arr, shuffle=False, idx_min=None, idx_max=None,
-                 rng=None):
+                 rng=None, cache=None, block_size=None, block_window=4,
+                 readahead=0, readahead_workers=2):
+        # When viewing into another delayed_view, fold (a snapshot of) its
+        # index map into this one so that reads go directly to the underlying
+        # array.
+        length = len(arr)
+        base_indices = None
+        if isinstance(arr, delayed_view) \
+                                and not isinstance(arr, multi_source_array):
+            base_indices = arr.arr_indices
+            arr = arr.arr
+        if cache is not None and hasattr(arr, 'shape'):
+            arr = cached_array(arr, cache)
         self.arr = arr
         self.shuffle = shuffle
         self.idx_min = idx_min
@@ -37,11 +609,17 @@ class delayed_view(object):
             self.idx_min = 0
         self.idx_max = idx_max
         if idx_max is None:
-            self.idx_max = len(self.arr)
+            self.idx_max = length
         if rng is None:
             rng = np.random.RandomState()
         self.rng = rng
-        self.num_items = min(self.idx_max, len(arr))-self.idx_min
+        if block_size is None:
+            block_size = _get_chunk_length(arr) or 1
+        self.block_size = block_size
+        self.block_window = block_window
+        self.readahead = readahead
+        self.readahead_workers = readahead_workers
+        self.num_items = min(self.idx_max, length)-self.idx_min
         assert(self.num_items >= 0)
         self.dtype = self.arr.dtype
         try:
@@ -52,93 +630,183 @@ class delayed_view(object):
         self.ndim = len(elem_shape)+1
             
         # Create index list
-        self.arr_indices = np.arange(self.idx_min, min(self.idx_max, len(arr)))
+        self.arr_indices = np.arange(self.idx_min, min(self.idx_max, length))
+        if base_indices is not None:
+            self.arr_indices = base_indices[self.arr_indices]
+        self._contiguous = len(self.arr_indices)==0 \
+                           or np.all(np.diff(self.arr_indices)==1)
         if self.shuffle:
-            self.rng.shuffle(self.arr_indices)
+            self.re_shuffle()
             
     def re_shuffle(self, random_seed=None):
         rng = self.rng
         if random_seed is not None:
             rng = np.random.RandomState(random_seed)
-        rng.shuffle(self.arr_indices)
+        if self.shuffle=='block':
+            block_ids = self.arr_indices//self.block_size
+            order = _block_shuffle(block_ids, self.block_window, rng)
+            self.arr_indices = self.arr_indices[order]
+        else:
+            rng.shuffle(self.arr_indices)
+        self._contiguous = False
+        
+    def reopen(self):
+        """
+        Return a copy of this view into the viewed array reopened (see
+        file_source.reopen()). The index is shared with this view.
+        """
+        view = copy.copy(self)
+        view.arr = _reopen(self.arr)
+        return view
     
     def __iter__(self):
+        if self.readahead:
+            for block in self._iter_blocks(self._get_readahead_blocks()):
+                for elem in block:
+                    yield elem
+            return
         for idx in self.arr_indices:
             idx = int(idx)  # Some libraries don't like np.integer
             yield self.arr[idx]
             
+    def _get_readahead_blocks(self):
+        # Split the view into blocks of `block_size` elements. When the view is
+        # in order, align the blocks to the chunks of the source array.
+        first = self.block_size
+        if self._contiguous and len(self.arr_indices):
+            first -= int(self.arr_indices[0])%self.block_size
+        starts = np.arange(first, self.num_items, self.block_size)
+        bounds = np.concatenate([[0], starts, [self.num_items]])
+        return [slice(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])
+                if b > a]
+    
+    def _iter_blocks(self, keys):
+        # Yield self[key] for each key, in order. With readahead, the next
+        # `readahead` blocks are read in a thread pool in the meantime.
+        if not self.readahead:
+            for key in keys:
+                yield self[key]
+            return
+        keys = iter(keys)
+        pool = ThreadPoolExecutor(max_workers=self.readahead_workers)
+        pending = deque()
+        try:
+            for key in itertools.islice(keys, self.readahead):
+                pending.append(pool.submit(self.__getitem__, key))
+            while pending:
+                block = pending.popleft().result()
+                for key in itertools.islice(keys, 1):
+                    pending.append(pool.submit(self.__getitem__, key))
+                yield block
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            
+    def _iter_batch_keys(self, batch_size):
+        return [slice(i, min(i+batch_size, self.num_items))
+                for i in range(0, self.num_items, batch_size)]
+    
+    def iter_batches(self, batch_size, out=None):
+        """
+        Iterate over the view in order, yielding contiguous numpy arrays of up
+        to `batch_size` elements (the last batch may be smaller). Each batch is
+        read with bulk reads (and read ahead, if readahead is set).
+        
+        batch_size : the number of elements in each batch
+        out        : (optional) an array of at least `batch_size` elements into
+            which every batch is written; if passed, each yielded batch is a
+            view into `out` that is overwritten by the next batch
+        """
+        keys = self._iter_batch_keys(batch_size)
+        if out is not None and not self.readahead and not self._no_shape():
+            # Read every batch straight into `out`.
+            for key in keys:
+                yield self._read_batch_into(key, out[:key.stop-key.start])
+            return
+        for key, batch in zip(keys, self._iter_blocks(keys)):
+            if out is not None:
+                out[:len(batch)] = batch
+                batch = out[:len(batch)]
+            yield batch
+            
+    def _no_shape(self):
+        # Whether the source must be read element by element.
+        return not hasattr(self.arr, 'shape')
+    
+    def _read_batch_into(self, key, out):
+        # Read the elements at the slice `key` of the view into `out`.
+        return _gather(self.arr, self.arr_indices[key], out=out)
+            
     def _get_element(self, int_key, key_remainder=None):
         if not isinstance(int_key, (int, np.integer)):
             raise IndexError("cannot index with {}".format(type(int_key)))
-        idx = self.arr_indices[int_key]
+        idx = int(self.arr_indices[int_key])  # Some libraries don't like
+                                              # np.integer
         if key_remainder is not None:
             idx = (idx,)+key_remainder
-        idx = int(idx)  # Some libraries don't like np.integer
         return self.arr[idx]
     
+    def _get_positions(self, values):
+        # Convert a list of indices into the view into an integer array.
+        positions = np.asarray(values)
+        if positions.size==0:
+            positions = positions.astype(np.int64)
+        elif positions.dtype.kind not in 'iu':
+            raise IndexError("cannot index with {}".format(positions.dtype))
+        return positions.ravel()
+    
     def _get_block(self, values, key_remainder=None):
+        if hasattr(self.arr, 'shape'):
+            # Read every contiguous run of source elements at once.
+            indices = self.arr_indices[self._get_positions(values)]
+            return _gather(self.arr, indices, key_remainder)
+        return self._get_block_by_element(values, key_remainder)
+    
+    def _get_slice(self, key, key_remainder=None):
+        start, stop, step = key.indices(self.num_items)
+        simple_key = _is_simple_key(key_remainder)
+        if self._contiguous and step==1 and hasattr(self.arr, 'shape') \
+                      and (simple_key or isinstance(self.arr, np.ndarray)):
+            # The view is in order: take a slice of the source directly (for
+            # numpy arrays and memory maps, this is a view without a copy).
+            stop = max(start, stop)
+            offset = self.arr_indices[0] if len(self.arr_indices) else 0
+            source_key = slice(int(offset+start), int(offset+stop))
+            if key_remainder is not None:
+                source_key = (source_key,)+key_remainder
+            return self.arr[source_key]
+        if not simple_key:
+            # Index arrays apply to every element in the slice: read whole
+            # elements, then apply the index arrays in memory.
+            elements = self._get_slice(key)
+            return elements[(slice(None),)+key_remainder]
+        return self._get_block(range(start, stop, step), key_remainder)
+    
+    def _get_block_by_element(self, values, key_remainder=None):
+        # Used for sources that do not support reading blocks of elements.
+        positions = self._get_positions(values)
         item_block = None
-        for i, v in enumerate(values):
-            # Lists in the aggregate key index in tandem;
-            # so, index into those lists (the first list is `values`)
+        for i, v in enumerate(positions):
+            # Index arrays in the key remainder index in tandem with `values`.
             v_key_remainder = key_remainder
-            if isinstance(values, tuple) or isinstance(values, list):
-                if key_remainder is not None:
-                    broadcasted_key_remainder = ()
-                    for k in key_remainder:
-                        if hasattr(k, '__len__') and len(k)==np.size(k):
-                            broadcasted_key_remainder += (k[i],)
-                        else:
-                            broadcasted_key_remainder += (k,)
-                    v_key_remainder = broadcasted_key_remainder
+            if key_remainder is not None:
+                v_key_remainder = tuple([k[i] if isinstance(k, np.ndarray)
+                                         else k for k in key_remainder])
             
             # Make a single read at an integer index of axis 0
             elem = self._get_element(v, v_key_remainder)
             if item_block is None:
-                item_block = np.zeros((len(values),)+elem.shape,
+                item_block = np.zeros((len(positions),)+np.shape(elem),
                                       self.dtype)
             item_block[i] = elem
         return item_block
                 
     def __getitem__(self, key):
         item = None
-        key_remainder = None
         
         # Grab the key for the first dimension, store the remainder
-        if hasattr(key, '__len__'):
-            if isinstance(key, np.ndarray):
-                if key.dtype == np.bool:
-                    if key.ndim != self.ndim:
-                        raise IndexError("not enough indices, given a boolean "
-                                         "index array with shape "
-                                         "{}".format(np.shape(key)))
-                    key = key.nonzero()
-                elif key.ndim > 1:
-                    raise IndexError("indexing by non-boolean multidimensional"
-                                     " arrays not supported")
-                
-            # If there are lists in the key, make sure they have the same shape
-            key_shapes = []
-            for k in key:
-                if hasattr(k, '__len__'):
-                    key_shapes.append(np.shape(k))
-            for s in key_shapes:
-                if s!=key_shapes[0]:
-                    raise IndexError("shape mismatch: indexing arrays could "
-                                     "not be broadcast together with shapes "
-                                     ""+" ".join([str(s) for s in key_shapes]))
-            if len(key_shapes) > self.ndim:
-                # More sublists/subtuples than dimensions in the array
-                raise IndexError("too many indices for array")
-            
-            # If there are iterables in the key, or if the key is a tuple, then
-            # each key index corresponds to a separate data dimension (as per
-            # Numpy). Otherwise, such as when the key is a list of integers,
-            # each index corresponds only to the first data dimension.
-            key_remainder = None
-            if len(key_shapes) or isinstance(key, tuple):
-                key_remainder = tuple(key[1:])
-                key = key[0]
+        key, key_remainder = _split_key(key, self.ndim)
             
         # Handle ellipsis
         if key is Ellipsis:
@@ -151,11 +819,7 @@ class delayed_view(object):
         if isinstance(key, (int, np.integer)):
             item = self._get_element(key, key_remainder)
         elif isinstance(key, slice):
-            start = key.start if key.start is not None else 0
-            stop = key.stop if key.stop is not None else self.num_items
-            stop = min(stop, self.num_items)
-            step = key.step if key.step is not None else 1
-            item = self._get_block(range(start, stop, step), key_remainder)
+            item = self._get_slice(key, key_remainder)
         elif hasattr(key, '__len__'):
             item = self._get_block(key, key_remainder)
         else:
@@ -179,19 +843,50 @@ class multi_source_array(delayed_view):
     source_list : list of sources to combine into one source
     class_list  : specifies class number for each source; same length as
         source_list
-    shuffle     : randomize data access order within and across all sources
+    shuffle     : randomize data access order within and across all sources;
+        if 'block', shuffle blocks of consecutive elements within each source
+        and then shuffle elements within a sliding window of blocks, as
+        detailed in wrap.delayed_view
     maxlen      : the maximum number of elements to take from each source; if
         shuffle is False, a source is accessed as source[0:maxlen] and if
         shuffle is True, a source is accessed as shuffle(source)[0:maxlen]
     no_shape : whether to ignore the shapes of sources; if True, the resulting
         wrapper has a shape of None but retains a length attribute like a list.
     rng         : numpy random number generator
+    cache       : (optional) a chunk_cache through which to read all sources
+    block_size  : the number of elements in a block for block shuffling; if
+        None, it is taken from the chunk shape of each source, if available,
+        else 1
+    block_window : the number of blocks over which elements are shuffled
+        together when block shuffling
+    readahead   : when iterating, the number of blocks of upcoming elements to
+        read ahead in background threads (each block is as long as the
+        largest block size); if 0, no data is read ahead
+    readahead_workers : the number of threads that read ahead
+    index_file  : (optional) an index file written by save_index(); if
+        passed, the index, shuffle state, and metadata are loaded from this
+        file (see load_index()) instead of being built from the sources
     """
     
     def __init__(self, source_list, class_list=None, shuffle=False,
-                 maxlen=None, no_shape=False, rng=None):
+                 maxlen=None, no_shape=False, rng=None, cache=None,
+                 block_size=None, block_window=4, readahead=0,
+                 readahead_workers=2, index_file=None):
+        if cache is not None:
+            source_list = [cached_array(source, cache)
+                           if hasattr(source, 'shape') else source
+                           for source in source_list]
         self.source_list = source_list
         self.class_list = class_list
+        if rng is None:
+            rng = np.random.RandomState()
+        self.rng = rng
+        self.readahead = readahead
+        self.readahead_workers = readahead_workers
+        self._contiguous = False
+        if index_file is not None:
+            self.load_index(index_file)
+            return
         self.shuffle = shuffle
         self.maxlen = maxlen
         if self.maxlen == None:
@@ -221,46 +916,253 @@ class multi_source_array(delayed_view):
                     raise TypeError
         elem_shape = np.shape(self.source_list[0][0])
         self.ndim = len(elem_shape)+1
-        if rng is None:
-            rng = np.random.RandomState()
-        self.rng = rng
+        self.block_sizes = np.array([block_size or _get_chunk_length(source)
+                                     or 1 for source in self.source_list],
+                                    dtype=np.int64)
+        self.block_window = block_window
             
-        # Index the data sources
-        self.index_pairs = []
-        for i, source in enumerate(self.source_list):
-            source_indices = np.arange(len(source))
-            if self.shuffle:
-                self.rng.shuffle(source_indices)
-            source_indices = source_indices[:min(len(source), self.maxlen)]
-            for j in source_indices:
-                self.index_pairs.append((i, j))
-        if self.shuffle==True:
-            self.rng.shuffle(self.index_pairs)
+        # Index the data sources. The index is stored as two parallel arrays:
+        # the source number and the offset into that source of each element.
+        self.source_lengths = np.array([len(source)
+                                        for source in self.source_list],
+                                       dtype=np.int64)
+        source_lengths = [int(min(length, self.maxlen))
+                          for length in self.source_lengths]
+        source_dtype = np.min_scalar_type(max(len(self.source_list)-1, 0))
+        self.index_sources = np.repeat(
+            np.arange(len(self.source_list), dtype=source_dtype),
+            source_lengths)
+        offsets = []
+        for i, (source, length) in enumerate(zip(self.source_list,
+                                                 source_lengths)):
+            if self.shuffle=='block':
+                source_offsets = np.arange(len(source))
+                order = _block_shuffle(source_offsets//self.block_sizes[i],
+                                       self.block_window, self.rng)
+                offsets.append(source_offsets[order][:length])
+            elif self.shuffle:
+                offsets.append(self.rng.permutation(len(source))[:length])
+            else:
+                offsets.append(np.arange(length))
+        self.index_offsets = np.concatenate(offsets).astype(np.int64)
+        if self.shuffle:
+            self.re_shuffle()
+    
+    @property
+    def index_pairs(self):
+        """
+        The (index_sources, index_offsets) arrays, which give the source
+        number and the offset into that source of each element.
+        """
+        return (self.index_sources, self.index_offsets)
+    
+    @index_pairs.setter
+    def index_pairs(self, pairs):
+        index_sources, index_offsets = pairs
+        self.index_sources = np.asarray(index_sources)
+        self.index_offsets = np.asarray(index_offsets, dtype=np.int64)
             
     def re_shuffle(self, random_seed=None):
         rng = self.rng
         if random_seed is not None:
             rng = np.random.RandomState(random_seed)
-        rng.shuffle(self.index_pairs)
+        if self.shuffle=='block':
+            # Number the blocks uniquely across all sources.
+            block_ids = self.index_offsets \
+                        // self.block_sizes[self.index_sources]
+            block_ids = block_ids*len(self.source_list)+self.index_sources
+            order = _block_shuffle(block_ids, self.block_window, rng)
+        else:
+            order = rng.permutation(len(self.index_offsets))
+        self.index_sources = self.index_sources[order]
+        self.index_offsets = self.index_offsets[order]
+        
+    def reopen(self):
+        """
+        Return a copy of this array over the sources reopened (see
+        file_source.reopen()). Sources that were read through one chunk_cache
+        are read through one new, empty chunk_cache with the same byte
+        budget. The index is shared with this array.
+        """
+        caches = {}
+        source_list = []
+        for source in self.source_list:
+            if isinstance(source, cached_array):
+                cache = caches.setdefault(id(source.cache),
+                                          chunk_cache(source.cache.max_bytes))
+                source = source.reopen(cache)
+            else:
+                source = _reopen(source)
+            source_list.append(source)
+        view = copy.copy(self)
+        view.source_list = source_list
+        return view
+        
+    def save_index(self, path):
+        """
+        Save the index, per-source lengths, dtype and shape metadata, and
+        shuffle state (including the state of the random number generator) to
+        an uncompressed .npz file at `path` (as with numpy.savez, the '.npz'
+        extension is appended if it is missing). The index can then be loaded
+        with load_index() or by passing `index_file` to the constructor, which
+        skips reading the sources.
+        """
+        rng_state = self.rng.get_state()
+        class_list = self.class_list
+        np.savez(path,
+                 index_sources=self.index_sources,
+                 index_offsets=self.index_offsets,
+                 source_lengths=self.source_lengths,
+                 block_sizes=self.block_sizes,
+                 block_window=self.block_window,
+                 dtype=np.zeros(0, dtype=self.dtype),
+                 shape=np.array(self.shape if self.shape is not None else [],
+                                dtype=np.int64),
+                 ndim=self.ndim,
+                 no_shape=self.no_shape,
+                 shuffle=str(self.shuffle),
+                 maxlen=float(self.maxlen),
+                 class_list=np.array(class_list if class_list is not None
+                                     else []),
+                 has_class_list=class_list is not None,
+                 rng_keys=rng_state[1],
+                 rng_pos=rng_state[2],
+                 rng_has_gauss=rng_state[3],
+                 rng_cached_gaussian=rng_state[4])
+        
+    def load_index(self, path):
+        """
+        Load an index saved with save_index() from the .npz file at `path` (as
+        with numpy.load, the '.npz' extension is appended if it is missing).
+        The index arrays are memory mapped, so that loading takes constant time
+        regardless of the dataset size and processes that load the same file
+        share its pages. The sources are not accessed; they must be the same as
+        when the index was saved. If no class_list was passed to this object,
+        the saved class_list is used.
+        """
+        if not path.endswith('.npz'):
+            path = path+'.npz'
+        with np.load(path) as npz:
+            if len(npz['source_lengths'])!=len(self.source_list):
+                raise ValueError("The index in {} is for {} sources but {} "
+                                 "sources were given."
+                                 "".format(path, len(npz['source_lengths']),
+                                           len(self.source_list)))
+            self.source_lengths = npz['source_lengths']
+            self.block_sizes = npz['block_sizes']
+            self.block_window = int(npz['block_window'])
+            self.dtype = npz['dtype'].dtype
+            self.no_shape = bool(npz['no_shape'])
+            self.shape = None
+            if not self.no_shape:
+                self.shape = tuple(int(n) for n in npz['shape'])
+            self.ndim = int(npz['ndim'])
+            shuffle = str(npz['shuffle'])
+            self.shuffle = {'True': True, 'False': False}.get(shuffle, shuffle)
+            self.maxlen = float(npz['maxlen'])
+            if np.isfinite(self.maxlen):
+                self.maxlen = int(self.maxlen)
+            if self.class_list is None and bool(npz['has_class_list']):
+                self.class_list = npz['class_list']
+            self.rng.set_state(('MT19937',
+                                npz['rng_keys'],
+                                int(npz['rng_pos']),
+                                int(npz['rng_has_gauss']),
+                                float(npz['rng_cached_gaussian'])))
+        self.index_sources = _memmap_npz_member(path, 'index_sources')
+        self.index_offsets = _memmap_npz_member(path, 'index_offsets')
+        self.num_items = len(self.index_offsets)
     
     def get_labels(self):
-        labels = []
-        for p in self.index_pairs:
-            if not self.class_list:
-                labels.append(p[0])
+        return self._get_labels(slice(None))
+    
+    def _get_labels(self, key):
+        if self.class_list is None:
+            return np.array(self.index_sources[key])
+        return np.asarray(self.class_list)[self.index_sources[key]]
+    
+    def iter_batches(self, batch_size, out=None):
+        """
+        Iterate over the array in order, yielding (batch, labels) pairs, where
+        each batch is a contiguous numpy array of up to `batch_size` elements
+        (the last batch may be smaller) and labels is a numpy array of the
+        corresponding labels (see get_labels()). Each batch is read with one
+        bulk read per source (and read ahead, if readahead is set).
+        
+        batch_size : the number of elements in each batch
+        out        : (optional) an array of at least `batch_size` elements into
+            which every batch is written; if passed, each yielded batch is a
+            view into `out` that is overwritten by the next batch
+        """
+        keys = self._iter_batch_keys(batch_size)
+        batches = super(multi_source_array, self).iter_batches(batch_size,
+                                                               out=out)
+        for key, batch in zip(keys, batches):
+            yield batch, self._get_labels(key)
+            
+    def _no_shape(self):
+        return self.no_shape
+    
+    def _read_batch_into(self, key, out):
+        # Make one bulk read per source, straight into `out` for the sources
+        # whose elements are contiguous in the batch.
+        sources = self.index_sources[key]
+        offsets = self.index_offsets[key]
+        for group in _group_positions(sources):
+            source = self.source_list[sources[group[0]]]
+            a, b = int(group[0]), int(group[-1])+1
+            if b-a==len(group):
+                _gather(source, offsets[a:b], out=out[a:b])
             else:
-                labels.append(self.class_list[ p[0] ])
-        return labels
+                out[group] = _gather(source, offsets[group])
+        return out
     
     def __iter__(self):
-        for source_num, idx in self.index_pairs:
-            yield self.source_list[source_num][idx]
+        if self.readahead:
+            for block in self._iter_blocks(self._get_readahead_blocks()):
+                for elem in block:
+                    yield elem
+            return
+        for source_num, idx in zip(self.index_sources, self.index_offsets):
+            yield self.source_list[source_num][int(idx)]
+            
+    def _get_readahead_blocks(self):
+        block_size = int(np.max(self.block_sizes))
+        return [slice(i, min(i+block_size, self.num_items))
+                for i in range(0, self.num_items, block_size)]
             
     def _get_element(self, int_key, key_remainder=None):
         if not isinstance(int_key, (int, np.integer)):
             raise IndexError("cannot index with {}".format(type(int_key)))
-        source_num, idx = self.index_pairs[int_key]
+        source_num = self.index_sources[int_key]
+        idx = int(self.index_offsets[int_key])  # Some libraries don't like
+                                                # np.integer
         if key_remainder is not None:
             idx = (idx,)+key_remainder
-        idx = int(idx)  # Some libraries don't like np.integer
         return self.source_list[source_num][idx]
+    
+    def _get_block(self, values, key_remainder=None):
+        if self.no_shape:
+            return self._get_block_by_element(values, key_remainder)
+        
+        # Group the requested elements by source and make one bulk read per
+        # source, then merge the elements back in the requested order.
+        positions = self._get_positions(values)
+        sources = self.index_sources[positions]
+        offsets = self.index_offsets[positions]
+        if len(positions)==0:
+            return _gather(self.source_list[0], offsets, key_remainder)
+        item_block = None
+        for group in _group_positions(sources):
+            source = self.source_list[sources[group[0]]]
+            group_key_remainder = key_remainder
+            if key_remainder is not None:
+                group_key_remainder = tuple([k[group]
+                                             if isinstance(k, np.ndarray)
+                                             else k for k in key_remainder])
+            elements = _gather(source, offsets[group], group_key_remainder)
+            if item_block is None:
+                item_block = np.empty((len(positions),)+elements.shape[1:],
+                                      dtype=elements.dtype)
+            item_block[group] = elements
+        return item_block